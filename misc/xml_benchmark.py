@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+import uuid
+import xml.etree.ElementTree as element_tree
+
+# this is a tool to compare the XML backends on multi-key CPIX requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from cpix_model import CpixDocument  # noqa: E402
+from cpix_writer import CpixWriter  # noqa: E402
+from xml_backend import create_xml_backend, lxml_etree  # noqa: E402
+
+WIDEVINE_SYSTEM_ID = "edef8ba9-79d6-4ace-a3c8-27dcd51d21ed"
+
+
+def request_body(key_count):
+    """
+    Return a SPEKE v2 style request with one ContentKey, usage rule and DRMSystem per key
+    """
+    kids = [str(uuid.uuid4()) for _ in range(key_count)]
+    content_keys = "".join('\n    <cpix:ContentKey kid="{}" commonEncryptionScheme="cenc"/>'.format(kid) for kid in kids)
+    usage_rules = "".join('\n    <cpix:ContentKeyUsageRule kid="{}" intendedTrackType="VIDEO"><cpix:VideoFilter/></cpix:ContentKeyUsageRule>'.format(kid) for kid in kids)
+    drm_systems = "".join('\n    <cpix:DRMSystem kid="{}" systemId="{}"><cpix:PSSH/><cpix:ContentProtectionData/></cpix:DRMSystem>'.format(kid, WIDEVINE_SYSTEM_ID) for kid in kids)
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<cpix:CPIX xmlns:cpix="urn:dashif:org:cpix" xmlns:pskc="urn:ietf:params:xml:ns:keyprov:pskc" contentId="benchmark" version="2.3">'
+            '\n  <cpix:ContentKeyList>{}\n  </cpix:ContentKeyList>'
+            '\n  <cpix:ContentKeyUsageRuleList>{}\n  </cpix:ContentKeyUsageRuleList>'
+            '\n  <cpix:DRMSystemList>{}\n  </cpix:DRMSystemList>'
+            '\n</cpix:CPIX>').format(content_keys, usage_rules, drm_systems).encode('utf-8')
+
+
+def respond(backend, body):
+    """
+    Parse a request and write a response with a value for every key
+    """
+    root = backend.parse(body)
+    document = CpixDocument(root, backend)
+    writer = CpixWriter()
+    for content_key in document.content_keys:
+        data = writer.append(content_key.element, "{urn:dashif:org:cpix}Data")
+        data.append("{urn:ietf:params:xml:ns:keyprov:pskc}Secret").append("{urn:ietf:params:xml:ns:keyprov:pskc}PlainValue", text="AAAAAAAAAAAAAAAAAAAAAA==")
+    for drm_system in document.drm_systems:
+        writer.set_text(drm_system.child("{urn:dashif:org:cpix}PSSH"), "AAAAAA==")
+    return writer.write(root)
+
+
+def best_of(function, repeat, number):
+    """
+    Return the best time of one call in milliseconds
+    """
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number * 1000
+
+
+parser = argparse.ArgumentParser(description="Compare the XML backends on multi-key CPIX requests")
+parser.add_argument("--keys", type=int, nargs="+", default=[1, 10, 100, 1000])
+parser.add_argument("--repeat", type=int, default=5)
+arguments = parser.parse_args()
+
+element_tree.register_namespace("cpix", "urn:dashif:org:cpix")
+element_tree.register_namespace("pskc", "urn:ietf:params:xml:ns:keyprov:pskc")
+backends = [create_xml_backend("elementtree")]
+if lxml_etree is not None:
+    backends.append(create_xml_backend("lxml"))
+else:
+    print("lxml is not installed, only the elementtree backend is measured")
+
+print("{:>6} {:>12} {:>10} {:>10} {:>10}".format("keys", "backend", "parse ms", "model ms", "total ms"))
+for key_count in arguments.keys:
+    body = request_body(key_count)
+    number = max(1, 1000 // key_count)
+    responses = set()
+    for backend in backends:
+        root = backend.parse(body)
+        parse_time = best_of(lambda: backend.parse(body), arguments.repeat, number)
+        model_time = best_of(lambda: CpixDocument(root, backend), arguments.repeat, number)
+        total_time = best_of(lambda: respond(backend, body), arguments.repeat, number)
+        responses.add(respond(backend, body))
+        print("{:>6} {:>12} {:>10.3f} {:>10.3f} {:>10.3f}".format(key_count, backend.name, parse_time, model_time, total_time))
+    if len(responses) != 1:
+        print("the backends wrote different responses for {} keys".format(key_count))
@@ -0,0 +1,67 @@
+"""
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+# pooled connections per client, at least the key store writers plus the secret loaders
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "32"))
+# a request that has not connected or answered by now is retried, well inside the Lambda timeout
+AWS_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("AWS_CONNECT_TIMEOUT_SECONDS", "1"))
+AWS_READ_TIMEOUT_SECONDS = float(os.environ.get("AWS_READ_TIMEOUT_SECONDS", "3"))
+# "adaptive" adds client side rate limiting to the standard retry mode when throttled
+AWS_RETRY_MODE = os.environ.get("AWS_RETRY_MODE", "adaptive")
+# retries after the first attempt
+AWS_MAX_ATTEMPTS = int(os.environ.get("AWS_MAX_ATTEMPTS", "3"))
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def client_config():
+    """
+    Return the botocore settings shared by every client
+    """
+    return Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        connect_timeout=AWS_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=AWS_READ_TIMEOUT_SECONDS,
+        retries={'mode': AWS_RETRY_MODE, 'max_attempts': AWS_MAX_ATTEMPTS},
+        tcp_keepalive=True)
+
+
+def get_client(service_name, endpoint_url=None):
+    """
+    Return the client for an AWS service, creating it on first use so
+    every subsystem shares its connection pool and retry state
+    """
+    key = (service_name, endpoint_url)
+    client = _CLIENTS.get(key)
+    if client is None:
+        # creating clients from the default session is not thread safe
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = boto3.client(service_name, endpoint_url=endpoint_url, config=client_config())
+                _CLIENTS[key] = client
+    return client
+
+
+def reset_clients():
+    """
+    Discard every client so the next call to get_client() creates new ones,
+    for example after the container credentials have expired
+    """
+    with _CLIENTS_LOCK:
+        _CLIENTS.clear()
@@ -0,0 +1,97 @@
+"""
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+CPIX_NAMESPACE = "{urn:dashif:org:cpix}"
+DSIG_NAMESPACE = "{http://www.w3.org/2000/09/xmldsig#}"
+
+DELIVERY_DATA_LIST = CPIX_NAMESPACE + "DeliveryDataList"
+DELIVERY_DATA = CPIX_NAMESPACE + "DeliveryData"
+DELIVERY_KEY = CPIX_NAMESPACE + "DeliveryKey"
+X509_DATA = DSIG_NAMESPACE + "X509Data"
+X509_CERTIFICATE = DSIG_NAMESPACE + "X509Certificate"
+DRM_SYSTEM_LIST = CPIX_NAMESPACE + "DRMSystemList"
+DRM_SYSTEM = CPIX_NAMESPACE + "DRMSystem"
+CONTENT_KEY_LIST = CPIX_NAMESPACE + "ContentKeyList"
+CONTENT_KEY = CPIX_NAMESPACE + "ContentKey"
+HLS_SIGNALING_DATA = CPIX_NAMESPACE + "HLSSignalingData"
+
+
+class ContentKey:
+    """
+    This class is responsible for holding a requested content key
+    """
+
+    __slots__ = ("element", "kid", "explicit_iv")
+
+    def __init__(self, element):
+        self.element = element
+        self.kid = element.get("kid")
+        self.explicit_iv = element.get("explicitIV")
+
+
+class DRMSystem:
+    """
+    This class is responsible for holding a requested DRM system and
+    its child elements, indexed by tag and HLS playlist
+    """
+
+    __slots__ = ("element", "kid", "system_id", "system_id_lower", "children", "hls_signaling_data")
+
+    def __init__(self, element):
+        self.element = element
+        self.kid = element.get("kid")
+        self.system_id = element.get("systemId")
+        self.system_id_lower = self.system_id.lower()
+        # first child with each tag, the same element find() returns
+        self.children = {}
+        self.hls_signaling_data = {}
+        for child in element:
+            self.children.setdefault(child.tag, child)
+            if child.tag == HLS_SIGNALING_DATA:
+                self.hls_signaling_data.setdefault(child.get("playlist"), child)
+
+    def child(self, tag):
+        """
+        Return the first child element with a tag, raising if there is none
+        """
+        element = self.children.get(tag)
+        if element is None:
+            raise Exception("Missing {} in DRMSystem {}".format(tag, self.system_id))
+        return element
+
+
+class DeliveryData:
+    """
+    This class is responsible for holding a recipient of an encrypted response
+    """
+
+    __slots__ = ("element", "certificate")
+
+    def __init__(self, element, x509_certificate):
+        self.element = element
+        self.certificate = x509_certificate.text if x509_certificate is not None else None
+
+
+class CpixDocument:
+    """
+    This class is responsible for holding the parts of a CPIX request
+    used to build the response. The lists below the root are read once
+    by the XML backend, keeping references to the elements.
+    """
+
+    __slots__ = ("root", "delivery_data", "drm_systems", "content_keys")
+
+    def __init__(self, root, xml_backend):
+        self.root = root
+        delivery_data, drm_systems, content_keys = xml_backend.select_lists(root)
+        self.delivery_data = [DeliveryData(element, xml_backend.certificate(element)) for element in delivery_data]
+        self.drm_systems = [DRMSystem(element) for element in drm_systems]
+        self.content_keys = [ContentKey(element) for element in content_keys]
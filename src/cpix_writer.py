@@ -0,0 +1,289 @@
+"""
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import xml.etree.ElementTree as element_tree
+
+
+def escape_text(text):
+    """
+    Escape element text the way ElementTree does
+    """
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def escape_attribute(text):
+    """
+    Escape an attribute value the way ElementTree does
+    """
+    text = escape_text(text)
+    if "\"" in text:
+        text = text.replace("\"", "&quot;")
+    if "\r" in text:
+        text = text.replace("\r", "&#13;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    if "\t" in text:
+        text = text.replace("\t", "&#09;")
+    return text
+
+
+class XmlNode:
+    """
+    This class is responsible for holding an element added to the
+    response, such as the Data of a ContentKey
+    """
+
+    __slots__ = ("tag", "attributes", "text", "children")
+
+    def __init__(self, tag, attributes=None, text=None):
+        self.tag = tag
+        self.attributes = attributes or []
+        self.text = text
+        self.children = []
+
+    def append(self, tag, attributes=None, text=None):
+        """
+        Add a child node and return it
+        """
+        node = XmlNode(tag, attributes, text)
+        self.children.append(node)
+        return node
+
+
+class CpixWriter:
+    """
+    This class is responsible for writing the response document, which is
+    the request tree with replaced text, removed elements and added
+    elements and attributes, without modifying the request tree.
+
+    The output is identical to ElementTree.tostring() of the modified tree:
+    namespace prefixes are taken from register_namespace() or numbered in
+    the order the namespaces are first used, and every declaration is
+    written on the root element. The document is written in a single pass
+    into a list of parts with a placeholder for the declarations, which
+    are only known at the end, and joined once.
+    """
+
+    def __init__(self):
+        self.texts = {}
+        self.attributes = {}
+        self.appended = {}
+        self.removed = set()
+        self.parts = []
+        self.namespaces = {}
+        self.qnames = {}
+        self.declarations = None
+        # parts before this index have already been joined by compact()
+        self.compacted = 0
+
+    def set_text(self, element, text):
+        """
+        Replace the text of a request element
+        """
+        self.texts[element] = text
+
+    def set_attribute(self, element, name, value):
+        """
+        Add or replace an attribute of a request element
+        """
+        self.attributes.setdefault(element, []).append((name, value))
+
+    def append(self, element, tag, attributes=None, text=None):
+        """
+        Add a node after the children of a request element and return it
+        """
+        node = XmlNode(tag, attributes, text)
+        self.appended.setdefault(element, []).append(node)
+        return node
+
+    def remove(self, element):
+        """
+        Leave a request element and its tail out of the response
+        """
+        self.removed.add(element)
+
+    def qname(self, name):
+        """
+        Return the prefixed name for a {uri}local name, recording its namespace
+        """
+        qname = self.qnames.get(name)
+        if qname is not None:
+            return qname
+        if name[:1] == "{":
+            uri, local = name[1:].rsplit("}", 1)
+            prefix = self.namespaces.get(uri)
+            if prefix is None:
+                # the registry shared with ElementTree, so prefixes always match tostring()
+                prefix = element_tree._namespace_map.get(uri)
+                if prefix is None:
+                    prefix = "ns%d" % len(self.namespaces)
+                if prefix != "xml":
+                    self.namespaces[uri] = prefix
+            qname = "%s:%s" % (prefix, local) if prefix else local
+        else:
+            qname = name
+        self.qnames[name] = qname
+        return qname
+
+    def start_tag(self, tag, items):
+        """
+        Write a start tag without its closing bracket, reserving the place
+        of the namespace declarations on the first (root) element
+        """
+        write = self.parts.append
+        write("<" + self.qname(tag))
+        if self.declarations is None:
+            self.declarations = len(self.parts)
+            write("")
+        for name, value in items:
+            write(" %s=\"%s\"" % (self.qname(name), escape_attribute(value)))
+
+    def end_tag(self, tag):
+        """
+        Write an end tag
+        """
+        self.parts.append("</" + self.qname(tag) + ">")
+
+    def write_text(self, text):
+        """
+        Write element text or a tail
+        """
+        if text:
+            self.parts.append(escape_text(text))
+
+    def element_items(self, element):
+        """
+        Return the attributes of a request element with the added attributes
+        """
+        items = element.items()
+        added = self.attributes.get(element)
+        if added:
+            items = list(items)
+            for name, value in added:
+                for index, (existing_name, _) in enumerate(items):
+                    if existing_name == name:
+                        items[index] = (name, value)
+                        break
+                else:
+                    items.append((name, value))
+        return items
+
+    def write_element(self, element):
+        """
+        Write a request element with its changes and children, but not its tail
+        """
+        tag = element.tag
+        text = self.texts.get(element, element.text)
+        children = [child for child in element if child not in self.removed] if self.removed else element
+        appended = self.appended.get(element)
+        self.start_tag(tag, self.element_items(element))
+        if text or len(children) or appended:
+            self.parts.append(">")
+            self.write_text(text)
+            for child in children:
+                # entity references left unresolved by lxml are not elements
+                if isinstance(child.tag, str):
+                    self.write_element(child)
+                self.write_text(child.tail)
+            if appended:
+                for node in appended:
+                    self.write_node(node)
+            self.end_tag(tag)
+        else:
+            self.parts.append(" />")
+
+    def write_open(self, element):
+        """
+        Write the start tag of a request element whose children are
+        written one at a time, without its closing bracket
+        """
+        self.start_tag(element.tag, self.element_items(element))
+
+    def write_open_content(self, element):
+        """
+        Close the start tag of an open request element that has children and write its text
+        """
+        self.parts.append(">")
+        self.write_text(self.texts.get(element, element.text))
+
+    def write_close(self, element, has_children):
+        """
+        Write the end of an open request element, the same as write_element()
+        """
+        if has_children:
+            self.end_tag(element.tag)
+            return
+        text = self.texts.get(element, element.text)
+        if text:
+            self.parts.append(">")
+            self.write_text(text)
+            self.end_tag(element.tag)
+        else:
+            self.parts.append(" />")
+
+    def compact(self):
+        """
+        Join the parts written since the last call into one, so a long
+        streamed response is held as a few large strings
+        """
+        if self.declarations is None:
+            return
+        start = max(self.compacted, self.declarations + 1)
+        if len(self.parts) - start > 1:
+            self.parts[start:] = ["".join(self.parts[start:])]
+        self.compacted = len(self.parts)
+
+    def release(self, element):
+        """
+        Forget the changes of a written request element and its descendants
+        """
+        for descendant in element.iter():
+            self.texts.pop(descendant, None)
+            self.attributes.pop(descendant, None)
+            self.appended.pop(descendant, None)
+            self.removed.discard(descendant)
+
+    def write_node(self, node):
+        """
+        Write an added node and its children
+        """
+        self.start_tag(node.tag, node.attributes)
+        if node.text or node.children:
+            self.parts.append(">")
+            self.write_text(node.text)
+            for child in node.children:
+                self.write_node(child)
+            self.end_tag(node.tag)
+        else:
+            self.parts.append(" />")
+
+    def getvalue(self):
+        """
+        Return the document written so far, with the namespace declarations
+        filled in and characters outside ASCII written as character references
+        """
+        if self.declarations is not None:
+            self.parts[self.declarations] = "".join(" xmlns%s=\"%s\"" % (":" + prefix if prefix else "", escape_attribute(uri)) for uri, prefix in sorted(self.namespaces.items(), key=lambda item: item[1]))
+        return "".join(self.parts).encode("ascii", "xmlcharrefreplace").decode("ascii")
+
+    def write(self, root):
+        """
+        Write the whole response document and return it
+        """
+        self.write_element(root)
+        self.write_text(root.tail)
+        return self.getvalue()
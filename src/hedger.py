@@ -0,0 +1,128 @@
+"""
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# hedging of idempotent key store writes and secret reads, "true" to enable
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "false") == "true"
+# a second request is sent when the first is slower than this percentile of recent requests
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+# delay used until enough requests have been timed
+HEDGE_INITIAL_DELAY_MS = float(os.environ.get("HEDGE_INITIAL_DELAY_MS", "100"))
+HEDGE_MIN_DELAY_MS = float(os.environ.get("HEDGE_MIN_DELAY_MS", "5"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(os.environ.get("HEDGE_WINDOW", "1000"))
+# never hedge more than this fraction of requests, so a slow service is not doubly loaded
+HEDGE_MAX_RATE = float(os.environ.get("HEDGE_MAX_RATE", "0.1"))
+HEDGE_WORKERS = int(os.environ.get("HEDGE_WORKERS", "32"))
+
+
+class Hedger:
+    """
+    This class is responsible for cutting the tail latency of idempotent
+    requests. When a request has not completed within a delay taken from
+    the latency distribution of recent requests, an identical second
+    request is sent and the first successful answer is used.
+    """
+
+    def __init__(self, name, enabled=HEDGE_ENABLED):
+        self.name = name
+        self.enabled = enabled
+        self.latencies = deque(maxlen=HEDGE_WINDOW)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="speke-hedge-{}".format(name)) if enabled else None
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_skips = 0
+
+    def delay(self):
+        """
+        Return the hedging delay in seconds
+        """
+        with self.lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return HEDGE_INITIAL_DELAY_MS / 1000
+            latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * HEDGE_PERCENTILE / 100))
+        return max(latencies[index], HEDGE_MIN_DELAY_MS / 1000)
+
+    def timed(self, function, args):
+        """
+        Run one request and record its latency if it succeeds
+        """
+        started = time.monotonic()
+        result = function(*args)
+        with self.lock:
+            self.latencies.append(time.monotonic() - started)
+        return result
+
+    def call(self, function, *args):
+        """
+        Call an idempotent function, sending a second identical call if
+        the first is slow, and return the first successful result
+        """
+        if not self.enabled:
+            return function(*args)
+        with self.lock:
+            self.requests += 1
+        first = self.executor.submit(self.timed, function, args)
+        done, _ = wait([first], timeout=self.delay())
+        if done:
+            return first.result()
+        with self.lock:
+            within_budget = self.hedged < self.requests * HEDGE_MAX_RATE
+            if within_budget:
+                self.hedged += 1
+            else:
+                self.budget_skips += 1
+        if not within_budget:
+            return first.result()
+        print("HEDGE {}".format(self.name))
+        second = self.executor.submit(self.timed, function, args)
+        pending = {first, second}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        with self.lock:
+                            self.hedge_wins += 1
+                    return future.result()
+            if not pending:
+                # both requests failed
+                return first.result()
+
+    def close(self):
+        """
+        Stop the hedging threads once the requests already sent have completed
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def stats(self):
+        """
+        Return the hedging counters
+        """
+        delay = self.delay()
+        with self.lock:
+            return {
+                "delay_ms": round(delay * 1000, 1),
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "budget_skips": self.budget_skips,
+                "hedge_rate": self.hedged / self.requests if self.requests else 0.0
+            }
@@ -9,33 +9,129 @@ specific language governing permissions and limitations
 under the License.
 """
 
-import boto3
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from hedger import Hedger
+
+# number of keys written to the key cache concurrently
+KEYSTORE_WORKERS = int(os.environ.get("KEYSTORE_WORKERS", "16"))
+# number of (content ID, key ID) pairs remembered as already stored
+KEYSTORE_KNOWN_KEYS_MAX = int(os.environ.get("KEYSTORE_KNOWN_KEYS_MAX", "100000"))
+# a stored key is written again after this long, in case it has been removed since
+KEYSTORE_KNOWN_KEYS_TTL_SECONDS = int(os.environ.get("KEYSTORE_KNOWN_KEYS_TTL_SECONDS", "86400"))
 
 
 class KeyCache:
     """
-    This class is responsible for storing keys in the key cache (S3) and
-    returning a URL that can return a specific key from the cache.
+    This class is responsible for storing keys in the key cache (a key
+    store such as S3) and returning a URL that can return a specific key
+    from the cache.
     """
 
-    def __init__(self, keystore_bucket, client_url_prefix):
-        self.keystore_bucket = keystore_bucket
+    def __init__(self, key_store, client_url_prefix):
+        self.key_store = key_store
         self.client_url_prefix = client_url_prefix
+        self.store_executor = ThreadPoolExecutor(max_workers=KEYSTORE_WORKERS, thread_name_prefix="speke-store")
+        # keys are deterministic, so a key stored once never needs to be written again
+        self.known_keys = OrderedDict()
+        self.known_keys_max = KEYSTORE_KNOWN_KEYS_MAX
+        self.known_keys_ttl = KEYSTORE_KNOWN_KEYS_TTL_SECONDS
+        self.known_keys_lock = threading.Lock()
+        self.skipped_writes = 0
+        self.put_hedger = Hedger("put")
 
     def store(self, content_id, key_id, key_value):
         """
-        Store a key into the cache (S3) using the content_id
-        as a folder and key_id as the file
+        Store a key into the cache (key store) using the content_id
+        and key_id as its location
+        """
+        if not getattr(self.key_store, 'stores_keys', True) or self.is_known(content_id, key_id):
+            return
+        self.put_hedger.call(self.key_store.put, content_id, key_id, key_value)
+        self.remember(content_id, key_id)
+
+    def is_known(self, content_id, key_id):
+        """
+        Check whether this process has already stored a key, counting the skipped write
+        """
+        with self.known_keys_lock:
+            remembered = self.known_keys.get((content_id, key_id))
+            if remembered is None:
+                return False
+            if time.monotonic() - remembered >= self.known_keys_ttl:
+                del self.known_keys[(content_id, key_id)]
+                return False
+            self.known_keys.move_to_end((content_id, key_id))
+            self.skipped_writes += 1
+            return True
+
+    def remember(self, content_id, key_id):
+        """
+        Record a stored key, forgetting the least recently used one when full
+        """
+        with self.known_keys_lock:
+            self.known_keys[(content_id, key_id)] = time.monotonic()
+            while len(self.known_keys) > self.known_keys_max:
+                self.known_keys.popitem(last=False)
+
+    def store_many(self, content_id, keys):
+        """
+        Store keys from an iterable of (key_id, key_value) pairs concurrently.
+        Each write starts as soon as its key (or a full batch of keys, for
+        key stores that write in batches) is produced, so a generator that
+        is still deriving keys overlaps with the uploads of earlier ones.
+        Returns the keys by key ID once every write has completed.
+        """
+        stored = {}
+        writes = []
+        batch = []
+        stores_keys = getattr(self.key_store, 'stores_keys', True)
+        for key_id, key_value in keys:
+            stored[key_id] = key_value
+            if not stores_keys or self.is_known(content_id, key_id):
+                continue
+            batch.append((key_id, key_value))
+            if len(batch) >= self.key_store.batch_size:
+                writes.append(self.store_executor.submit(self.store_batch, content_id, batch))
+                batch = []
+        if batch:
+            writes.append(self.store_executor.submit(self.store_batch, content_id, batch))
+        # wait for every write, raising the first failure
+        for write in writes:
+            write.result()
+        return stored
+
+    def store_batch(self, content_id, batch):
+        """
+        Store a batch of (key_id, key_value) pairs for a content ID
+        """
+        if len(batch) == 1:
+            self.put_hedger.call(self.key_store.put, content_id, batch[0][0], batch[0][1])
+        else:
+            self.key_store.put_many(content_id, batch)
+        for key_id, _ in batch:
+            self.remember(content_id, key_id)
+
+    def stats(self):
+        """
+        Return the key store write counters
+        """
+        return {"skipped_writes": self.skipped_writes, "hedge": self.put_hedger.stats()}
+
+    def close(self):
+        """
+        Stop the write threads once the writes already started have completed
         """
-        key = "{cid}/{kid}".format(cid=content_id, kid=key_id)
-        s3_client = boto3.client('s3')
-        # store the key file with public-read permissions
-        # public bucket policy not required
-        s3_client.put_object(Bucket=self.keystore_bucket, Key=key, Body=key_value)
+        self.store_executor.shutdown(wait=False)
+        self.put_hedger.close()
 
     def url(self, content_id, key_id):
         """
         Return a URL that can be used to retrieve the
         specified key_id related to content_id
         """
-        return "{}/{}/{}".format(self.client_url_prefix, content_id, key_id)
+        return "{}/{}".format(self.client_url_prefix, self.key_store.location(content_id, key_id))
@@ -0,0 +1,125 @@
+"""
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import os
+import threading
+
+from aws_clients import reset_clients
+from key_cache import KeyCache
+from key_generator import KeyGenerator
+from key_store import create_key_store
+from secret_backend import create_secret_backend
+from secret_prefetch import SECRET_PREFETCH_MANIFEST, SecretPrefetcher
+
+CLIENT_URL_PREFIX = os.environ["KEYSTORE_URL"]
+
+# error codes that mean the container credentials have to be reloaded
+EXPIRED_CREDENTIALS_ERROR_CODES = ('ExpiredToken', 'ExpiredTokenException', 'RequestExpired')
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+
+class KeyEngine:
+    """
+    This class is responsible for holding the key store, secret backend,
+    key cache and key generator (and the AWS clients inside them) that
+    are shared by every invocation served by the same Lambda container.
+    """
+
+    def __init__(self, client_url_prefix, key_store=None, secret_backend=None):
+        self.secret_backend = secret_backend if secret_backend is not None else create_secret_backend()
+        self.generator = KeyGenerator(secret_backend=self.secret_backend)
+        self.key_store = key_store if key_store is not None else create_key_store(generator=self.generator)
+        self.cache = KeyCache(self.key_store, client_url_prefix)
+        self.prefetcher = None
+        if SECRET_PREFETCH_MANIFEST:
+            self.prefetcher = SecretPrefetcher(self.generator, SECRET_PREFETCH_MANIFEST)
+            self.prefetcher.prefetch()
+
+    def record_content_id(self, content_id):
+        """
+        Note a content ID served by this container for the prefetch manifest
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.record(content_id)
+
+    def close(self):
+        """
+        Stop the worker threads (and processes) of the key cache and key generator
+        """
+        self.cache.close()
+        self.generator.close()
+
+    def stats(self):
+        """
+        Return the counters of the secret cache tiers and key store writes, including hedging
+        """
+        return {"secrets": self.generator.cache_stats(), "key_store": self.cache.stats()}
+
+
+def get_engine():
+    """
+    Return the engine for this process, building it on first use
+    """
+    global _ENGINE
+    engine = _ENGINE
+    if engine is None:
+        with _ENGINE_LOCK:
+            if _ENGINE is None:
+                print("ENGINE-INIT")
+                _ENGINE = KeyEngine(CLIENT_URL_PREFIX)
+            engine = _ENGINE
+    return engine
+
+
+def warm_engine():
+    """
+    Build the engine during container initialization, leaving any
+    failure to be reported by the first invocation
+    """
+    try:
+        get_engine()
+    except Exception as exception:
+        print("ENGINE-INIT-FAILED {}".format(exception))
+
+
+def set_engine(engine):
+    """
+    Replace the engine for this process, for example with one built
+    around local stand-ins for the AWS clients
+    """
+    global _ENGINE
+    with _ENGINE_LOCK:
+        _ENGINE = engine
+
+
+def reset_engine():
+    """
+    Discard the engine so the next call to get_engine() builds new
+    clients, for example after the container credentials have expired
+    """
+    global _ENGINE
+    reset_clients()
+    with _ENGINE_LOCK:
+        engine = _ENGINE
+        _ENGINE = None
+    if engine is not None:
+        # invocations already running on the old engine finish their queued work first
+        engine.close()
+
+
+def is_expired_credentials_error(error):
+    """
+    Check whether an AWS client error was caused by expired credentials
+    """
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in EXPIRED_CREDENTIALS_ERROR_CODES
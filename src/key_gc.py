@@ -0,0 +1,173 @@
+"""
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from key_cache import KEYSTORE_KNOWN_KEYS_TTL_SECONDS
+from key_engine import get_engine
+from key_store import S3_DELETE_BATCH_SIZE
+from secret_backend import SECRET_ACCESS_RESOLUTION_SECONDS
+
+# content IDs whose secret has not been read for this many days are removed
+KEY_GC_RETENTION_DAYS = int(os.environ.get("KEY_GC_RETENTION_DAYS", "365"))
+KEY_GC_SHARDS = int(os.environ.get("KEY_GC_SHARDS", "16"))
+KEY_GC_WORKERS = int(os.environ.get("KEY_GC_WORKERS", "16"))
+# only report what would be removed unless this is "false"
+KEY_GC_DRY_RUN = os.environ.get("KEY_GC_DRY_RUN", "true") != "false"
+# number of expired content IDs listed in the report
+KEY_GC_REPORT_SAMPLE = int(os.environ.get("KEY_GC_REPORT_SAMPLE", "100"))
+
+
+class KeyGarbageCollector:
+    """
+    This class is responsible for removing content IDs that have been idle
+    for longer than the retention window: their stored secret, any local
+    copy of the secret and, for key stores that can be scanned, their key
+    objects.
+
+    A content ID is idle when its secret has not been read within the
+    window. Every container serving a content ID reads its secret from the
+    secret backend at least once per secret cache TTL, so the access time
+    kept by the backend (LastAccessedDate for Secrets Manager) covers every
+    SPEKE request, including content IDs created before this job existed.
+    Keys in the template's key bucket and key table expire on their own
+    after KeyRetentionDays, so players cannot outlive the secret there.
+
+    A removed content ID must never be used again: a new request would need
+    a new secret and different keys, which cannot decrypt content packaged
+    before the removal, and Secrets Manager refuses to create the secret
+    while the deleted one can still be restored.
+    """
+
+    def __init__(self, key_store, secret_backend, generator, retention_days=KEY_GC_RETENTION_DAYS, shards=KEY_GC_SHARDS, workers=KEY_GC_WORKERS):
+        if not hasattr(secret_backend, 'idle_content_ids'):
+            raise Exception("The {} secret backend does not support garbage collection".format(type(secret_backend).__name__))
+        # access times are only kept to the day and a server process only writes a known key again after the TTL
+        if retention_days * 86400 <= SECRET_ACCESS_RESOLUTION_SECONDS + KEYSTORE_KNOWN_KEYS_TTL_SECONDS:
+            raise Exception("The retention of {} days is shorter than the secret access resolution and known keys TTL".format(retention_days))
+        self.key_store = key_store
+        self.secret_backend = secret_backend
+        self.generator = generator
+        self.retention_days = retention_days
+        self.shards = shards
+        self.workers = workers
+
+    def scan_shard(self, shard, content_ids):
+        """
+        Return the key locations of the given content IDs found in a shard
+        """
+        locations = {}
+        for content_id, location in self.key_store.scan(shard):
+            if content_id in content_ids:
+                locations.setdefault(content_id, []).append(location)
+        return locations
+
+    def scan(self, executor, content_ids):
+        """
+        Scan every shard in parallel and merge the key locations of the given
+        content IDs, the keys of one content ID can be spread over several
+        shards in the hashed layout
+        """
+        locations = {}
+        shards = self.key_store.scan_shards(self.shards)
+        for shard_locations in executor.map(lambda shard: self.scan_shard(shard, content_ids), shards):
+            for content_id, content_locations in shard_locations.items():
+                locations.setdefault(content_id, []).extend(content_locations)
+        return locations
+
+    def is_expired(self, content_id, cutoff):
+        """
+        Check the secret access time of a content ID again just before it is removed
+        """
+        try:
+            accessed = self.secret_backend.last_accessed(content_id)
+        except Exception as exception:
+            print("ACCESS-TIME-FAILED {} {}".format(content_id, exception))
+            return False
+        return accessed is not None and accessed < cutoff
+
+    def delete_secret(self, content_id):
+        """
+        Delete the stored and local secret of a content ID
+        """
+        try:
+            deleted = self.secret_backend.delete(content_id)
+        except Exception as exception:
+            print("DELETE-SECRET-FAILED {} {}".format(content_id, exception))
+            return False
+        self.generator.forget_content_id_secret(content_id)
+        return deleted
+
+    def run(self, dry_run=KEY_GC_DRY_RUN):
+        """
+        Find the idle content IDs, remove them unless this is a dry run, and return a report
+        """
+        started = time.time()
+        cutoff = started - self.retention_days * 86400
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="speke-gc") as executor:
+            idle = sorted(self.secret_backend.idle_content_ids(cutoff))
+            # listing every secret can take a while, a content ID may have been requested since
+            expired = [content_id for content_id, still_idle in zip(idle, executor.map(lambda content_id: self.is_expired(content_id, cutoff), idle)) if still_idle]
+            key_locations = {}
+            if expired and hasattr(self.key_store, 'scan_shards'):
+                key_locations = self.scan(executor, set(expired))
+            locations = [location for content_id in expired for location in key_locations.get(content_id, [])]
+            report = {
+                "dry_run": dry_run,
+                "retention_days": self.retention_days,
+                "cutoff": datetime.fromtimestamp(cutoff, timezone.utc).isoformat(),
+                "idle_content_ids": len(idle),
+                "expired_content_ids": len(expired),
+                "expired_keys": len(locations),
+                "expired": expired[:KEY_GC_REPORT_SAMPLE]
+            }
+            if not dry_run:
+                batches = [locations[start:start + S3_DELETE_BATCH_SIZE] for start in range(0, len(locations), S3_DELETE_BATCH_SIZE)]
+                failed = set(location for batch_failed in executor.map(self.key_store.delete, batches) for location in batch_failed)
+                # keep the secret while any of its keys remain, so the keys can still be derived
+                complete = [content_id for content_id in expired if not failed.intersection(key_locations.get(content_id, []))]
+                report["deleted_keys"] = len(locations) - len(failed)
+                report["deleted_secrets"] = sum(1 for deleted in executor.map(self.delete_secret, complete) if deleted)
+        report["seconds"] = round(time.time() - started, 1)
+        print("GC-REPORT {}".format(json.dumps(report)))
+        return report
+
+
+def create_garbage_collector(retention_days=KEY_GC_RETENTION_DAYS, shards=KEY_GC_SHARDS):
+    """
+    Create a garbage collector for the key store and secret backend of this process
+    """
+    engine = get_engine()
+    return KeyGarbageCollector(engine.key_store, engine.secret_backend, engine.generator, retention_days, shards)
+
+
+def gc_handler(event, context):
+    """
+    This function is the entry point for the scheduled garbage collection
+    Lambda. The event may override dry_run, retention_days and shards.
+    """
+    event = event or {}
+    collector = create_garbage_collector(int(event.get('retention_days', KEY_GC_RETENTION_DAYS)), int(event.get('shards', KEY_GC_SHARDS)))
+    return collector.run(dry_run=event.get('dry_run', KEY_GC_DRY_RUN) not in (False, "false"))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Remove the keys and secrets of idle content IDs")
+    parser.add_argument("--retention-days", type=int, default=KEY_GC_RETENTION_DAYS)
+    parser.add_argument("--shards", type=int, default=KEY_GC_SHARDS)
+    parser.add_argument("--delete", action="store_true", help="remove the idle content IDs instead of only reporting them")
+    arguments = parser.parse_args()
+    create_garbage_collector(arguments.retention_days, arguments.shards).run(dry_run=not arguments.delete)
@@ -10,13 +10,46 @@ under the License.
 """
 
 import hashlib
-# import secrets
+import os
+import secrets
+import string
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
-import boto3
-from botocore.exceptions import ClientError
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
+from hedger import Hedger
+from secret_backend import create_secret_backend
+from secret_cache import SecretCache
+
+# parallel key derivation settings, "thread" or "process" pool
+KEY_DERIVATION_POOL = os.environ.get("KEY_DERIVATION_POOL", "thread")
+KEY_DERIVATION_WORKERS = int(os.environ.get("KEY_DERIVATION_WORKERS", os.cpu_count() or 1))
+# requests with fewer distinct key IDs than this are derived inline
+KEY_DERIVATION_PARALLEL_THRESHOLD = int(os.environ.get("KEY_DERIVATION_PARALLEL_THRESHOLD", "4"))
+
+# in-memory content ID secret cache settings
+SECRET_CACHE_MAX_ENTRIES = int(os.environ.get("SECRET_CACHE_MAX_ENTRIES", "10000"))
+SECRET_CACHE_TTL_SECONDS = int(os.environ.get("SECRET_CACHE_TTL_SECONDS", "3600"))
+# content ID secret generator, "local" (CSPRNG) or "secretsmanager" (GetRandomPassword)
+SECRET_GENERATOR = os.environ.get("SECRET_GENERATOR", "local")
+# same character classes as Secrets Manager GetRandomPassword defaults
+SECRET_CHARACTER_CLASSES = (string.ascii_lowercase, string.ascii_uppercase, string.digits, string.punctuation)
+# content ID secret loads from the secret backend
+SECRET_LOAD_WORKERS = int(os.environ.get("SECRET_LOAD_WORKERS", "8"))
+SECRET_LOAD_TIMEOUT_SECONDS = float(os.environ.get("SECRET_LOAD_TIMEOUT_SECONDS", "5"))
+# maximum number of content ID secret files kept in the local folder
+LOCAL_SECRET_MAX_FILES = int(os.environ.get("LOCAL_SECRET_MAX_FILES", "10000"))
+
+
+def derive_pbkdf2_key(secret, kid, length, iterations):
+    """
+    Derive a key with PBKDF2HMAC-SHA256, usable from a thread or process pool
+    """
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=length, salt=secret.encode('utf-8'), iterations=iterations, backend=default_backend())
+    return kdf.derive(kid.encode('utf-8'))
 
 
 class KeyGenerator:
@@ -26,14 +59,39 @@ class KeyGenerator:
     secret data used by each content ID in key generation.
     """
 
-    def __init__(self):
+    def __init__(self, secret_backend=None):
         self.backend = default_backend()
         self.content_id_secret_length = 64
         self.derived_key_iterations = 5000
         self.derived_key_size = 16
         self.keyed_hash_digest_size = 16
         self.local_secret_folder = "/tmp"
-        self.secrets_client = boto3.client('secretsmanager')
+        self.local_secret_max_files = LOCAL_SECRET_MAX_FILES
+        self.local_secret_hits = 0
+        self.local_secret_misses = 0
+        self.local_secret_evictions = 0
+        self.local_secret_count = None
+        self.secret_cache = SecretCache(SECRET_CACHE_MAX_ENTRIES, SECRET_CACHE_TTL_SECONDS)
+        self.secret_requests = {}
+        self.secret_refreshes = set()
+        self.secret_requests_lock = threading.Lock()
+        self.secret_loader = ThreadPoolExecutor(max_workers=SECRET_LOAD_WORKERS, thread_name_prefix="speke-secret")
+        self.secret_load_timeout = SECRET_LOAD_TIMEOUT_SECONDS
+        self.secret_load_timeouts = 0
+        # secret reads are idempotent, so slow ones may be hedged
+        self.secret_hedger = Hedger("secret")
+        self.secret_backend_failures = 0
+        self.secret_backend_degraded = False
+        self.secret_backend = secret_backend if secret_backend is not None else create_secret_backend()
+        self.secret_generator = SECRET_GENERATOR
+        if self.secret_generator == "secretsmanager" and not hasattr(self.secret_backend, 'random_password'):
+            # only the Secrets Manager backend can generate passwords remotely
+            print("SECRET-GENERATOR-FALLBACK local {}".format(type(self.secret_backend).__name__))
+            self.secret_generator = "local"
+        self.derivation_pool = KEY_DERIVATION_POOL
+        self.derivation_workers = KEY_DERIVATION_WORKERS
+        self.derivation_threshold = KEY_DERIVATION_PARALLEL_THRESHOLD
+        self.derivation_executor = None
 
     def md5_key(self, secret, kid):
         """
@@ -57,8 +115,27 @@ class KeyGenerator:
         """
         Generate a key using a key derivation function (default)
         """
-        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=self.derived_key_size, salt=secret.encode('utf-8'), iterations=self.derived_key_iterations, backend=self.backend)
-        return kdf.derive(kid.encode('utf-8'))
+        return derive_pbkdf2_key(secret, kid, self.derived_key_size, self.derived_key_iterations)
+
+    def derivation_pool_executor(self):
+        """
+        Return the executor used for parallel key derivation, creating it on first use
+        """
+        if self.derivation_executor is None:
+            if self.derivation_pool == "process":
+                self.derivation_executor = ProcessPoolExecutor(max_workers=self.derivation_workers)
+            else:
+                self.derivation_executor = ThreadPoolExecutor(max_workers=self.derivation_workers, thread_name_prefix="speke-kdf")
+        return self.derivation_executor
+
+    def close(self):
+        """
+        Stop the secret loading and key derivation workers once their queued work has completed
+        """
+        self.secret_loader.shutdown(wait=False)
+        self.secret_hedger.close()
+        if self.derivation_executor is not None:
+            self.derivation_executor.shutdown(wait=False)
 
     def local_secret_path(self, content_id):
         """
@@ -70,6 +147,7 @@ class KeyGenerator:
         """
         Store a content ID secret file
         """
+        self.evict_local_secrets()
         secret_file = self.local_secret_path(content_id)
         secret_file = open(secret_file, 'w')
         secret_file.write(secret)
@@ -79,49 +157,232 @@ class KeyGenerator:
         """
         Retrieve a content ID secret file
         """
-        secret_file = self.local_secret_path(content_id)
-        secret_file = open(secret_file, 'r')
+        secret_path = self.local_secret_path(content_id)
+        try:
+            secret_file = open(secret_path, 'r')
+        except IOError:
+            self.local_secret_misses += 1
+            raise
         secret = secret_file.read()
         secret_file.close()
+        # refresh the modification time so eviction removes the least recently used files
+        os.utime(secret_path)
+        self.local_secret_hits += 1
         return secret
 
+    def evict_local_secrets(self):
+        """
+        Remove the least recently used content ID secret files when the local folder is full
+        """
+        # only scan the folder when the running count says it may be full
+        if self.local_secret_count is not None and self.local_secret_count < self.local_secret_max_files:
+            self.local_secret_count += 1
+            return
+        try:
+            entries = [entry for entry in os.scandir(self.local_secret_folder) if entry.name.startswith('speke.') and entry.is_file()]
+        except OSError:
+            return
+        # evict down to 90% of the limit so the folder is not rescanned on every store
+        excess = len(entries) - int(self.local_secret_max_files * 0.9) + 1 if len(entries) >= self.local_secret_max_files else 0
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:max(excess, 0)]:
+            try:
+                os.remove(entry.path)
+                self.local_secret_evictions += 1
+            except OSError:
+                pass
+        self.local_secret_count = len(entries) - max(excess, 0) + 1
+
+    def forget_content_id_secret(self, content_id):
+        """
+        Remove a content ID secret from the in-memory cache and the local folder
+        """
+        self.secret_cache.remove(content_id)
+        try:
+            os.remove(self.local_secret_path(content_id))
+        except FileNotFoundError:
+            return
+        if self.local_secret_count:
+            self.local_secret_count -= 1
+
+    def cache_stats(self):
+        """
+        Return the counters of the secret cache tiers and the secret backend health
+        """
+        return {
+            "memory": self.secret_cache.stats(),
+            "local": {"hits": self.local_secret_hits, "misses": self.local_secret_misses, "evictions": self.local_secret_evictions},
+            "backend": {"degraded": self.secret_backend_degraded, "timeouts": self.secret_load_timeouts, "failures": self.secret_backend_failures},
+            "hedge": self.secret_hedger.stats()
+        }
+
     def generate_content_id_secret(self):
         """
         Create a string of random text used in generating a key for a content ID/key ID
         """
-        # return secrets.token_hex(self.content_id_secret_length)
-        return self.secrets_client.get_random_password(PasswordLength=self.content_id_secret_length)['RandomPassword']
+        if self.secret_generator == "secretsmanager":
+            return self.secret_backend.random_password(self.content_id_secret_length)
+        return self.local_random_password(self.content_id_secret_length)
 
-    def retrieve_content_id_secret(self, content_id):
+    def local_random_password(self, length):
         """
-        Retrieve the secret value by content ID used for generating keys
+        Create a random password locally with the same alphabet and
+        each-character-class guarantee as Secrets Manager GetRandomPassword
+        """
+        alphabet = ''.join(SECRET_CHARACTER_CLASSES)
+        while True:
+            password = ''.join(secrets.choice(alphabet) for _ in range(length))
+            if all(any(character in character_class for character in password) for character_class in SECRET_CHARACTER_CLASSES):
+                return password
+
+    def create_content_id_secret(self, content_id):
         """
+        Create the secret value for a content ID, or return the existing
+        value if another process created it first
+        """
+        print("CREATE-SECRET {}".format(content_id))
+        return self.secret_backend.create(content_id, self.generate_content_id_secret())
+
+    def load_content_id_secret(self, content_id, create=True):
+        """
+        Load the secret value for a content ID from the local folder or
+        the secret backend, creating it if it does not exist yet (or
+        returning None when create is False)
+        """
+        if not self.secret_backend.cache_locally:
+            secret = self.secret_hedger.call(self.secret_backend.get, content_id)
+            if secret is None and create:
+                secret = self.create_content_id_secret(content_id)
+            return secret
         try:
             # cached locally?
             secret = self.retrieve_local_secret(content_id)
             print("CACHED-SECRET {}".format(content_id))
         except IOError:
-            # try secrets manager
-            secret_id = "speke/{}".format(content_id)
-            try:
-                response = self.secrets_client.get_secret_value(SecretId=secret_id)
-                secret = response['SecretString']
-                self.store_local_secret(content_id, secret)
+            # try the secret backend
+            secret = self.secret_hedger.call(self.secret_backend.get, content_id)
+            if secret is None:
+                if not create:
+                    return None
+                # we need a new secret value
+                secret = self.create_content_id_secret(content_id)
+            else:
                 print("RETRIEVE-SECRET {}".format(content_id))
-            except ClientError as error:
-                if error.response['Error']['Code'] == 'ResourceNotFoundException':
-                    # we need a new secret value
-                    print("CREATE-SECRET {}".format(content_id))
-                    secret = self.generate_content_id_secret()
-                    self.secrets_client.create_secret(Name=secret_id, SecretString=secret, Description='SPEKE content ID secret value for key generation')
-                    self.store_local_secret(content_id, secret)
-                else:
-                    # we're done trying
-                    raise error
+            self.store_local_secret(content_id, secret)
         return secret
 
+    def prefetch_content_id_secret(self, content_id):
+        """
+        Load an existing content ID secret into the in-memory cache,
+        returning False if the content ID has no secret
+        """
+        if self.secret_cache.get(content_id) is not None:
+            return True
+        secret = self.load_content_id_secret(content_id, create=False)
+        if secret is None:
+            return False
+        self.secret_cache.put(content_id, secret)
+        return True
+
+    def load_and_cache_content_id_secret(self, content_id):
+        """
+        Load a content ID secret into the in-memory cache, run by the secret loader pool
+        """
+        try:
+            secret = self.load_content_id_secret(content_id)
+            self.secret_cache.put(content_id, secret)
+            self.secret_backend_degraded = False
+            return secret
+        except Exception:
+            self.secret_backend_failures += 1
+            self.secret_backend_degraded = True
+            raise
+        finally:
+            with self.secret_requests_lock:
+                del self.secret_requests[content_id]
+
+    def refresh_content_id_secret(self, content_id):
+        """
+        Reload a stale content ID secret in the background, run by the secret loader pool
+        """
+        try:
+            # straight from the backend, the local file would always answer first
+            secret = self.secret_hedger.call(self.secret_backend.get, content_id)
+            if secret is None:
+                # the secret has been deleted, stop serving it
+                self.forget_content_id_secret(content_id)
+            else:
+                self.secret_cache.put(content_id, secret)
+                if self.secret_backend.cache_locally:
+                    self.store_local_secret(content_id, secret)
+            self.secret_backend_degraded = False
+        except Exception as exception:
+            # keep serving the cached copy
+            print("REFRESH-SECRET-FAILED {} {}".format(content_id, exception))
+            self.secret_backend_failures += 1
+            self.secret_backend_degraded = True
+        finally:
+            with self.secret_requests_lock:
+                self.secret_refreshes.discard(content_id)
+
+    def retrieve_content_id_secret(self, content_id):
+        """
+        Retrieve the secret value by content ID used for generating keys
+        """
+        # cached in memory?
+        secret, stale = self.secret_cache.lookup(content_id)
+        if secret is not None:
+            if stale:
+                # serve the cached copy now and refresh it asynchronously
+                with self.secret_requests_lock:
+                    refresh = content_id not in self.secret_refreshes
+                    if refresh:
+                        self.secret_refreshes.add(content_id)
+                if refresh:
+                    self.secret_loader.submit(self.refresh_content_id_secret, content_id)
+            return secret
+        # only one load per content ID goes to the file cache or secret backend
+        with self.secret_requests_lock:
+            request = self.secret_requests.get(content_id)
+            if request is None:
+                request = self.secret_loader.submit(self.load_and_cache_content_id_secret, content_id)
+                self.secret_requests[content_id] = request
+        try:
+            return request.result(timeout=self.secret_load_timeout)
+        except FutureTimeoutError:
+            # the load carries on in the background and fills the cache when it completes
+            print("SECRET-TIMEOUT {}".format(content_id))
+            self.secret_load_timeouts += 1
+            self.secret_backend_degraded = True
+            raise Exception("Timed out retrieving the secret for content ID {}".format(content_id))
+
     def key(self, content_id, key_id):
         """
         Return a symmetric key based on a content ID and key ID
         """
         return self.derived_key(self.retrieve_content_id_secret(content_id), key_id)
+
+    def keys(self, content_id, key_ids):
+        """
+        Return a dictionary of symmetric keys by key ID for a content ID,
+        retrieving the content ID secret once and deriving each distinct
+        key ID only once
+        """
+        return dict(self.iter_keys(content_id, key_ids))
+
+    def iter_keys(self, content_id, key_ids):
+        """
+        Yield (key ID, key) pairs for each distinct key ID of a content ID
+        as soon as each key has been derived
+        """
+        secret = self.retrieve_content_id_secret(content_id)
+        distinct_key_ids = list(dict.fromkeys(key_ids))
+        if self.derivation_workers > 1 and len(distinct_key_ids) >= self.derivation_threshold:
+            # PBKDF2 runs in OpenSSL, so large requests are spread over the pool
+            executor = self.derivation_pool_executor()
+            futures = {executor.submit(derive_pbkdf2_key, secret, key_id, self.derived_key_size, self.derived_key_iterations): key_id for key_id in distinct_key_ids}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        else:
+            for key_id in distinct_key_ids:
+                yield key_id, self.derived_key(secret, key_id)
@@ -10,17 +10,21 @@ under the License.
 """
 
 import base64
-import os
+import hashlib
+import json
 
 from flask import Flask
 from key_server_common import ServerResponseBuilder, ServerResponseBuilderV2
-from key_cache import KeyCache
-from key_generator import KeyGenerator
+from key_engine import get_engine, reset_engine, warm_engine, is_expired_credentials_error
+from key_store import KEY_CACHE_CONTROL, KEY_CONTENT_TYPE
 
 app = Flask(__name__)
 
-BUCKET_NAME = os.environ["KEYSTORE_BUCKET"]
-CLIENT_URL_PREFIX = os.environ["KEYSTORE_URL"]
+# missing keys may appear once the encryptor has requested them
+MISSING_KEY_CACHE_CONTROL = "public, max-age=10"
+
+# build clients and prefetch secrets while the container initializes
+warm_engine()
 
 
 def server_handler(event, context):
@@ -33,18 +37,79 @@ def server_handler(event, context):
         body = event['body']
         if event['isBase64Encoded']:
             body = base64.b64decode(body)
-        cache = KeyCache(BUCKET_NAME, CLIENT_URL_PREFIX)
-        generator = KeyGenerator()
+        # clients, cache and generator are reused across invocations
+        engine = get_engine()
+        cache = engine.cache
+        generator = engine.generator
         headers_from_event = event['headers']
         speke_version = headers_from_event.get('x-speke-version', '1.0')
 
         if speke_version == "2.0":
-            response = ServerResponseBuilderV2(body, cache, generator).get_response()
+            builder = ServerResponseBuilderV2(body, cache, generator)
         else:
-            response = ServerResponseBuilder(body, cache, generator).get_response()
-        
+            builder = ServerResponseBuilder(body, cache, generator)
+        response = builder.get_response()
+        engine.record_content_id(builder.get_content_id())
+
         print(response)
+        print("ENGINE-STATS {}".format(json.dumps(engine.stats())))
         return response
     except Exception as exception:
         print("EXCEPTION {}".format(exception))
+        if is_expired_credentials_error(exception):
+            # rebuild the clients with fresh credentials on the next invocation
+            reset_engine()
+        return {"isBase64Encoded": False, "statusCode": 500, "headers": {"Content-Type": "text/plain"}, "body": str(exception)}
+
+
+def etag_matches(event, etag):
+    """
+    Check whether the If-None-Match request header matches the ETag of a key
+    """
+    request_headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    if_none_match = request_headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        # weak comparison, as required for If-None-Match
+        if candidate == "*" or candidate.replace("W/", "", 1) == etag:
+            return True
+    return False
+
+
+def client_handler(event, context):
+    """
+    This function is the entry point for key retrieval by players. This
+    is invoked from the API Gateway /client/{content_id}/{kid} resource
+    and returns a key from the key store (or derives it again when the
+    derive key store is used).
+    """
+    try:
+        print(event)
+        path_parameters = event['pathParameters']
+        content_id = path_parameters.get('content_id', path_parameters.get('resource_id'))
+        kid = path_parameters['kid']
+        key_store = get_engine().key_store
+        key_value = None
+        # key stores that sign their key URLs only serve keys with a valid token
+        if hasattr(key_store, 'authorize') and not key_store.authorize(content_id, kid, (event.get('queryStringParameters') or {}).get('token')):
+            print("KEY-TOKEN-INVALID {} {}".format(content_id, kid))
+        else:
+            key_value = key_store.get(content_id, kid)
+        if key_value is None:
+            print("KEY-NOT-FOUND {} {}".format(content_id, kid))
+            return {"isBase64Encoded": False, "statusCode": 404, "headers": {"Content-Type": "text/plain", "Cache-Control": MISSING_KEY_CACHE_CONTROL}, "body": "Key not found"}
+        # same value as the ETag S3 returns for the key object
+        etag = '"{}"'.format(hashlib.md5(key_value).hexdigest())
+        headers = {"Content-Type": KEY_CONTENT_TYPE, "Cache-Control": KEY_CACHE_CONTROL, "ETag": etag}
+        if etag_matches(event, etag):
+            print("KEY-NOT-MODIFIED {} {}".format(content_id, kid))
+            return {"isBase64Encoded": False, "statusCode": 304, "headers": headers, "body": ""}
+        print("GET-KEY {} {}".format(content_id, kid))
+        return {"isBase64Encoded": True, "statusCode": 200, "headers": headers, "body": base64.b64encode(key_value).decode('utf-8')}
+    except Exception as exception:
+        print("EXCEPTION {}".format(exception))
+        if is_expired_credentials_error(exception):
+            reset_engine()
         return {"isBase64Encoded": False, "statusCode": 500, "headers": {"Content-Type": "text/plain"}, "body": str(exception)}
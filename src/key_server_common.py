@@ -20,6 +20,9 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, hmac, padding
 from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cpix_model import (CONTENT_KEY, CONTENT_KEY_LIST, DELIVERY_DATA, DELIVERY_DATA_LIST, DRM_SYSTEM, DRM_SYSTEM_LIST, ContentKey, CpixDocument, DeliveryData, DRMSystem)
+from cpix_writer import CpixWriter
+from xml_backend import create_xml_backend
 
 # HLS_AES_128_SYSTEM_ID is not an official system ID
 HLS_AES_128_SYSTEM_ID = '81376844-f976-481e-a84e-cc25d39b0b33'
@@ -34,6 +37,11 @@ HLS_AES_128_KEY_FORMAT = ''  # 'identity'
 HLS_AES_128_KEY_FORMAT_VERSIONS = '1'  # '1'
 HLS_SAMPLE_AES_KEY_FORMAT = 'com.apple.streamingkeydelivery'
 HLS_SAMPLE_AES_KEY_FORMAT_VERSIONS = '1'
+# the same settings as they are written in responses
+HLS_AES_128_KEY_FORMAT_BASE64 = base64.b64encode(HLS_AES_128_KEY_FORMAT.encode('utf-8')).decode('utf-8')
+HLS_AES_128_KEY_FORMAT_VERSIONS_BASE64 = base64.b64encode(HLS_AES_128_KEY_FORMAT_VERSIONS.encode('utf-8')).decode('utf-8')
+HLS_SAMPLE_AES_KEY_FORMAT_BASE64 = base64.b64encode(HLS_SAMPLE_AES_KEY_FORMAT.encode('utf-8')).decode('utf-8')
+HLS_SAMPLE_AES_KEY_FORMAT_VERSIONS_BASE64 = base64.b64encode(HLS_SAMPLE_AES_KEY_FORMAT_VERSIONS.encode('utf-8')).decode('utf-8')
 # speke v2.0 settings for fairplay drm
 FAIRPLAY_HLS_SIGNALING_DATA_MEDIA = os.environ["FAIRPLAY_HLS_SIGNALING_DATA_MEDIA"]
 FAIRPLAY_HLS_SIGNALING_DATA_MASTER = os.environ["FAIRPLAY_HLS_SIGNALING_DATA_MASTER"]
@@ -55,6 +63,16 @@ PLAYREADY_CONTENT_PROTECTION_DATA = os.environ["PLAYREADY_CONTENT_PROTECTION_DAT
 PLAYREADY_HLS_SIGNALING_DATA_MEDIA = os.environ["PLAYREADY_HLS_SIGNALING_DATA_MEDIA"]
 PLAYREADY_HLS_SIGNALING_DATA_MASTER = os.environ["PLAYREADY_HLS_SIGNALING_DATA_MASTER"]
 
+# request parser selected by the XML_BACKEND setting
+XML_BACKEND = create_xml_backend()
+# requests of this many bytes or more are filled while they are parsed instead of
+# being parsed into one tree first, 0 streams every request
+CPIX_STREAMING_THRESHOLD = int(os.environ.get("CPIX_STREAMING_THRESHOLD", "1048576"))
+# number of ContentKeys of a streamed request whose keys are derived and stored together
+CPIX_STREAMING_CHUNK_SIZE = int(os.environ.get("CPIX_STREAMING_CHUNK_SIZE", "256"))
+# streamed requests are always parsed with ElementTree
+STREAM_XML_BACKEND = create_xml_backend("elementtree")
+
 # globals for encrypted document responses
 DOCUMENT_KEY_SIZE = 32
 HMAC_KEY_SIZE = 64
@@ -71,38 +89,59 @@ class ServerResponseBuilder:
         self.error_message = ""
         self.cache = cache
         self.generator = generator
-        self.root = element_tree.fromstring(request_body)
+        self.request_body = request_body
+        self.streaming = len(request_body) >= CPIX_STREAMING_THRESHOLD
+        if self.streaming:
+            # set from the root element when the request is streamed
+            self.root = None
+            self.document = None
+        else:
+            self.root = XML_BACKEND.parse(request_body)
+            self.document = CpixDocument(self.root, XML_BACKEND)
+        # the response is written from the request tree and these changes, the tree is never modified
+        self.writer = CpixWriter()
         self.document_key = None
         self.hmac_key = None
         self.public_key = None
         self.use_playready_content_key = False
+        # DRMSystem key IDs by system ID, as written in the request
+        self.system_ids = {}
         element_tree.register_namespace("cpix", "urn:dashif:org:cpix")
         element_tree.register_namespace("pskc", "urn:ietf:params:xml:ns:keyprov:pskc")
         element_tree.register_namespace("speke", "urn:aws:amazon:com:speke")
         element_tree.register_namespace("ds", "http://www.w3.org/2000/09/xmldsig#")
         element_tree.register_namespace("enc", "http://www.w3.org/2001/04/xmlenc#")
 
-    def fixup_document(self, drm_system, system_id, content_id, kid):
+    def fill_hls_aes_128_drm_system(self, drm_system, content_id, kid):
+        """
+        Point an HLS AES-128 DRMSystem at the key URL and remove the DRM specific data
+        """
+        ext_x_key = self.cache.url(content_id, kid)
+        self.writer.set_text(drm_system.child("{urn:dashif:org:cpix}URIExtXKey"), base64.b64encode(ext_x_key.encode('utf-8')).decode('utf-8'))
+        self.writer.set_text(drm_system.child("{urn:aws:amazon:com:speke}KeyFormat"), HLS_AES_128_KEY_FORMAT_BASE64)
+        self.writer.set_text(drm_system.child("{urn:aws:amazon:com:speke}KeyFormatVersions"), HLS_AES_128_KEY_FORMAT_VERSIONS_BASE64)
+        self.safe_remove(drm_system, "{urn:dashif:org:cpix}ContentProtectionData")
+        self.safe_remove(drm_system, "{urn:aws:amazon:com:speke}ProtectionHeader")
+        self.safe_remove(drm_system, "{urn:dashif:org:cpix}PSSH")
+
+    def fixup_document(self, drm_system, content_id):
         """
         Update the returned XML document based on the specified system ID
         """
-        if system_id.lower() == HLS_AES_128_SYSTEM_ID.lower():
-            ext_x_key = self.cache.url(content_id, kid)
-            drm_system.find("{urn:dashif:org:cpix}URIExtXKey").text = base64.b64encode(ext_x_key.encode('utf-8')).decode('utf-8')
-            drm_system.find("{urn:aws:amazon:com:speke}KeyFormat").text = base64.b64encode(HLS_AES_128_KEY_FORMAT.encode('utf-8')).decode('utf-8')
-            drm_system.find("{urn:aws:amazon:com:speke}KeyFormatVersions").text = base64.b64encode(HLS_AES_128_KEY_FORMAT_VERSIONS.encode('utf-8')).decode('utf-8')
-            self.safe_remove(drm_system, "{urn:dashif:org:cpix}ContentProtectionData")
-            self.safe_remove(drm_system, "{urn:aws:amazon:com:speke}ProtectionHeader")
-            self.safe_remove(drm_system, "{urn:dashif:org:cpix}PSSH")
-        elif system_id.lower() == HLS_SAMPLE_AES_SYSTEM_ID.lower():
+        kid = drm_system.kid
+        # the system ID constants are lower case
+        system_id = drm_system.system_id_lower
+        if system_id == HLS_AES_128_SYSTEM_ID:
+            self.fill_hls_aes_128_drm_system(drm_system, content_id, kid)
+        elif system_id == HLS_SAMPLE_AES_SYSTEM_ID:
             ext_x_key = self.cache.url(content_id, kid)
-            drm_system.find("{urn:dashif:org:cpix}URIExtXKey").text = base64.b64encode(ext_x_key.encode('utf-8')).decode('utf-8')
-            drm_system.find("{urn:aws:amazon:com:speke}KeyFormat").text = base64.b64encode(HLS_SAMPLE_AES_KEY_FORMAT.encode('utf-8')).decode('utf-8')
-            drm_system.find("{urn:aws:amazon:com:speke}KeyFormatVersions").text = base64.b64encode(HLS_SAMPLE_AES_KEY_FORMAT_VERSIONS.encode('utf-8')).decode('utf-8')
+            self.writer.set_text(drm_system.child("{urn:dashif:org:cpix}URIExtXKey"), base64.b64encode(ext_x_key.encode('utf-8')).decode('utf-8'))
+            self.writer.set_text(drm_system.child("{urn:aws:amazon:com:speke}KeyFormat"), HLS_SAMPLE_AES_KEY_FORMAT_BASE64)
+            self.writer.set_text(drm_system.child("{urn:aws:amazon:com:speke}KeyFormatVersions"), HLS_SAMPLE_AES_KEY_FORMAT_VERSIONS_BASE64)
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}ContentProtectionData")
             self.safe_remove(drm_system, "{urn:aws:amazon:com:speke}ProtectionHeader")
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}PSSH")
-        elif system_id.lower() == COMMON_PSSH_SYSTEM_ID.lower():
+        elif system_id == COMMON_PSSH_SYSTEM_ID:
             pssh = bytearray([
                 # BMFF box header(52 bytes, 'pssh')
                 0x00, 0x00, 0x00, 0x34, 0x70, 0x73, 0x73, 0x68,
@@ -117,33 +156,31 @@ class ServerResponseBuilder:
             ])
             pssh[32:48] = uuid.UUID(kid).bytes
             base64pssh = base64.b64encode(pssh).decode('utf-8')
-            drm_system.find(
-                "{urn:dashif:org:cpix}PSSH").text = base64pssh
+            self.writer.set_text(drm_system.child("{urn:dashif:org:cpix}PSSH"), base64pssh)
             content_protection_data = '<pssh xmlns="urn:mpeg:cenc:2013">' + base64pssh + '</pssh>'
-            drm_system.find(
-                "{urn:dashif:org:cpix}ContentProtectionData").text = base64.b64encode(content_protection_data.encode('utf-8')).decode('utf-8')
+            self.writer.set_text(drm_system.child("{urn:dashif:org:cpix}ContentProtectionData"), base64.b64encode(content_protection_data.encode('utf-8')).decode('utf-8'))
             self.safe_remove(drm_system, "{urn:aws:amazon:com:speke}KeyFormat")
             self.safe_remove(
                 drm_system, "{urn:aws:amazon:com:speke}KeyFormatVersions")
             self.safe_remove(
                 drm_system, "{urn:aws:amazon:com:speke}ProtectionHeader")
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}URIExtXKey")
-        elif system_id.lower() == DASH_CENC_SYSTEM_ID.lower():
-            drm_system.find("{urn:dashif:org:cpix}PSSH").text = WIDEVINE_PSSH_BOX
+        elif system_id == DASH_CENC_SYSTEM_ID:
+            self.writer.set_text(drm_system.child("{urn:dashif:org:cpix}PSSH"), WIDEVINE_PSSH_BOX)
             self.safe_remove(drm_system, "{urn:aws:amazon:com:speke}KeyFormat")
             self.safe_remove(drm_system, "{urn:aws:amazon:com:speke}KeyFormatVersions")
             self.safe_remove(drm_system, "{urn:aws:amazon:com:speke}ProtectionHeader")
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}URIExtXKey")
-        elif system_id.lower() == PLAYREADY_SYSTEM_ID.lower():
-            drm_system.find("{urn:aws:amazon:com:speke}ProtectionHeader").text = PLAYREADY_PROTECTION_HEADER
-            drm_system.find("{urn:dashif:org:cpix}PSSH").text = PLAYREADY_PSSH_BOX
+        elif system_id == PLAYREADY_SYSTEM_ID:
+            self.writer.set_text(drm_system.child("{urn:aws:amazon:com:speke}ProtectionHeader"), PLAYREADY_PROTECTION_HEADER)
+            self.writer.set_text(drm_system.child("{urn:dashif:org:cpix}PSSH"), PLAYREADY_PSSH_BOX)
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}ContentProtectionData")
             self.safe_remove(drm_system, "{urn:aws:amazon:com:speke}KeyFormat")
             self.safe_remove(drm_system, "{urn:aws:amazon:com:speke}KeyFormatVersions")
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}URIExtXKey")
             self.use_playready_content_key = True
         else:
-            raise Exception("Invalid system ID {}".format(system_id))
+            raise Exception("Invalid system ID {}".format(drm_system.system_id))
 
     def get_content_id(self):
         return self.root.get("id")
@@ -153,87 +190,123 @@ class ServerResponseBuilder:
         Fill the XML document with data about the requested keys.
         """
         content_id = self.get_content_id()
-        # self.use_playready_content_key = False
-        system_ids = {}
+        if self.is_hls_aes_128_rotation():
+            self.fill_hls_aes_128_request(content_id)
+            return
         # check whether to perform CPIX 2.0 document encryption
-        encrypted_response_recipients = self.root.findall("./{urn:dashif:org:cpix}DeliveryDataList/{urn:dashif:org:cpix}DeliveryData")
-        if encrypted_response_recipients:
+        if self.document.delivery_data:
             print("ENCRYPTED-RESPONSE")
             # generate a random document key and HMAC key
             self.document_key = secrets.token_bytes(DOCUMENT_KEY_SIZE)
             self.hmac_key = secrets.token_bytes(HMAC_KEY_SIZE)
-            backend = default_backend()
-            for delivery_data in encrypted_response_recipients:
-                delivery_key = delivery_data.find("./{urn:dashif:org:cpix}DeliveryKey")
-                x509data = delivery_key.find("./{http://www.w3.org/2000/09/xmldsig#}X509Data")
-                x509cert = x509data.find("./{http://www.w3.org/2000/09/xmldsig#}X509Certificate")
-                cert = x509.load_der_x509_certificate(base64.b64decode(x509cert.text), backend)
-                public_key = cert.public_key()
-                self.public_key = x509cert.text
-                asym_padder = asym_padding.OAEP(mgf=asym_padding.MGF1(algorithm=hashes.SHA1()), algorithm=hashes.SHA1(), label=None)
-                # encrypt the document and HMAC keys using the x509 public key
-                encoded_document_key = public_key.encrypt(self.document_key, asym_padder)
-                encoded_hmac_key = public_key.encrypt(self.hmac_key, asym_padder)
-                # insert document key
-                document_key_leaf = element_tree.SubElement(delivery_data, "{urn:dashif:org:cpix}DocumentKey")
-                document_key_leaf.set("Algorithm", "http://www.w3.org/2001/04/xmlenc#aes256-cbc")
-                data_leaf = element_tree.SubElement(document_key_leaf, "{urn:dashif:org:cpix}Data")
-                secret_leaf = element_tree.SubElement(data_leaf, "{urn:ietf:params:xml:ns:keyprov:pskc}Secret")
-                self.insert_encrypted_value(secret_leaf, "http://www.w3.org/2001/04/xmlenc#rsa-oaep-mgf1p", base64.b64encode(encoded_document_key).decode('utf-8'))
-                # insert HMAC key
-                mac_method = element_tree.SubElement(delivery_data, "{urn:dashif:org:cpix}MACMethod")
-                mac_method.set("Algorithm", "http://www.w3.org/2001/04/xmldsig-more#hmac-sha512")
-                mac_method_key = element_tree.SubElement(mac_method, "{urn:dashif:org:cpix}Key")
-                self.insert_encrypted_value(mac_method_key, "http://www.w3.org/2001/04/xmlenc#rsa-oaep-mgf1p", base64.b64encode(encoded_hmac_key).decode('utf-8'))
+            for delivery_data in self.document.delivery_data:
+                self.fill_delivery_data(delivery_data)
         else:
             print("CLEAR-RESPONSE")
 
-        for drm_system in self.root.findall("./{urn:dashif:org:cpix}DRMSystemList/{urn:dashif:org:cpix}DRMSystem"):
-            kid = drm_system.get("kid")
-            system_id = drm_system.get("systemId")
-            system_ids[system_id] = kid
-            print("SYSTEM-ID {}".format(system_id.lower()))
-            self.fixup_document(drm_system, system_id, content_id, kid)
-
-        for content_key in self.root.findall("./{urn:dashif:org:cpix}ContentKeyList/{urn:dashif:org:cpix}ContentKey"):
-            kid = content_key.get("kid")
-            init_vector = content_key.get("explicitIV")
-            data = element_tree.SubElement(content_key, "{urn:dashif:org:cpix}Data")
-            secret = element_tree.SubElement(data, "{urn:ietf:params:xml:ns:keyprov:pskc}Secret")
-            # HLS SAMPLE AES Only
-            if init_vector is None and system_ids.get(HLS_SAMPLE_AES_SYSTEM_ID, False) == kid:
-                content_key.set('explicitIV', base64.b64encode(self.generator.key(content_id, kid)).decode('utf-8'))
-            # generate the key
-            key_bytes = self.generator.key(content_id, kid)
-            # store to the key in the cache
-            self.cache.store(content_id, kid, key_bytes)
-            # log
-            print("NEW-KEY {} {}".format(content_id, kid))
-            # update the encrypted response
-            if encrypted_response_recipients:
-                # store the key encrypted
-                padder = padding.PKCS7(algorithms.AES.block_size).padder()
-                padded_data = padder.update(key_bytes) + padder.finalize()
-                random_iv = secrets.token_bytes(RANDOM_IV_SIZE)
-                cipher = Cipher(algorithms.AES(self.document_key), modes.CBC(random_iv), backend=backend)
-                encryptor = cipher.encryptor()
-                encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
-                cipher_data = random_iv + encrypted_data
-                encrypted_string = base64.b64encode(cipher_data).decode('utf-8')
-                self.insert_encrypted_value(secret, "http://www.w3.org/2001/04/xmlenc#aes256-cbc", encrypted_string)
+        for drm_system in self.document.drm_systems:
+            self.fill_drm_system(drm_system, content_id)
+
+        content_keys = self.document.content_keys
+        # generate every requested key in one batch, storing each key in the cache as soon as it is derived
+        keys = self.cache.store_many(content_id, self.generator.iter_keys(content_id, [content_key.kid for content_key in content_keys]))
+        for content_key in content_keys:
+            self.fill_content_key(content_key, content_id, keys[content_key.kid])
+
+    def is_hls_aes_128_rotation(self):
+        """
+        Check whether the request is the common HLS AES-128 rotation request,
+        one clear ContentKey with one HLS AES-128 DRMSystem for the same key
+        """
+        document = self.document
+        return (not document.delivery_data and len(document.content_keys) == 1 and len(document.drm_systems) == 1
+                and document.drm_systems[0].system_id_lower == HLS_AES_128_SYSTEM_ID and document.drm_systems[0].kid == document.content_keys[0].kid)
+
+    def fill_hls_aes_128_request(self, content_id):
+        """
+        Fill an HLS AES-128 rotation request directly, with the same result as the general path
+        """
+        print("CLEAR-RESPONSE")
+        drm_system = self.document.drm_systems[0]
+        content_key = self.document.content_keys[0]
+        kid = content_key.kid
+        self.system_ids[drm_system.system_id] = kid
+        print("SYSTEM-ID {}".format(HLS_AES_128_SYSTEM_ID))
+        self.fill_hls_aes_128_drm_system(drm_system, content_id, kid)
+        # a single key is derived and stored inline, without the batch pools
+        key_bytes = self.generator.key(content_id, kid)
+        self.cache.store(content_id, kid, key_bytes)
+        print("NEW-KEY {} {}".format(content_id, kid))
+        secret = self.writer.append(content_key.element, "{urn:dashif:org:cpix}Data").append("{urn:ietf:params:xml:ns:keyprov:pskc}Secret")
+        secret.append("{urn:ietf:params:xml:ns:keyprov:pskc}PlainValue", text=base64.b64encode(key_bytes).decode('utf-8'))
+
+    def fill_delivery_data(self, delivery_data):
+        """
+        Add the document key and HMAC key, encrypted for one recipient, to its DeliveryData
+        """
+        if delivery_data.certificate is None:
+            raise Exception("Missing X509Certificate in DeliveryData")
+        cert = x509.load_der_x509_certificate(base64.b64decode(delivery_data.certificate), default_backend())
+        public_key = cert.public_key()
+        self.public_key = delivery_data.certificate
+        asym_padder = asym_padding.OAEP(mgf=asym_padding.MGF1(algorithm=hashes.SHA1()), algorithm=hashes.SHA1(), label=None)
+        # encrypt the document and HMAC keys using the x509 public key
+        encoded_document_key = public_key.encrypt(self.document_key, asym_padder)
+        encoded_hmac_key = public_key.encrypt(self.hmac_key, asym_padder)
+        # insert document key
+        document_key_leaf = self.writer.append(delivery_data.element, "{urn:dashif:org:cpix}DocumentKey", [("Algorithm", "http://www.w3.org/2001/04/xmlenc#aes256-cbc")])
+        data_leaf = document_key_leaf.append("{urn:dashif:org:cpix}Data")
+        secret_leaf = data_leaf.append("{urn:ietf:params:xml:ns:keyprov:pskc}Secret")
+        self.insert_encrypted_value(secret_leaf, "http://www.w3.org/2001/04/xmlenc#rsa-oaep-mgf1p", base64.b64encode(encoded_document_key).decode('utf-8'))
+        # insert HMAC key
+        mac_method = self.writer.append(delivery_data.element, "{urn:dashif:org:cpix}MACMethod", [("Algorithm", "http://www.w3.org/2001/04/xmldsig-more#hmac-sha512")])
+        mac_method_key = mac_method.append("{urn:dashif:org:cpix}Key")
+        self.insert_encrypted_value(mac_method_key, "http://www.w3.org/2001/04/xmlenc#rsa-oaep-mgf1p", base64.b64encode(encoded_hmac_key).decode('utf-8'))
+
+    def fill_drm_system(self, drm_system, content_id):
+        """
+        Fill the signaling data of one DRMSystem
+        """
+        self.system_ids[drm_system.system_id] = drm_system.kid
+        print("SYSTEM-ID {}".format(drm_system.system_id_lower))
+        self.fixup_document(drm_system, content_id)
+
+    def fill_content_key(self, content_key, content_id, key_bytes):
+        """
+        Add the key value, in the clear or encrypted, to one ContentKey
+        """
+        kid = content_key.kid
+        data = self.writer.append(content_key.element, "{urn:dashif:org:cpix}Data")
+        secret = data.append("{urn:ietf:params:xml:ns:keyprov:pskc}Secret")
+        # HLS SAMPLE AES Only
+        if content_key.explicit_iv is None and self.system_ids.get(HLS_SAMPLE_AES_SYSTEM_ID, False) == kid:
+            self.writer.set_attribute(content_key.element, 'explicitIV', base64.b64encode(key_bytes).decode('utf-8'))
+        # log
+        print("NEW-KEY {} {}".format(content_id, kid))
+        # update the encrypted response
+        if self.document_key:
+            # store the key encrypted
+            padder = padding.PKCS7(algorithms.AES.block_size).padder()
+            padded_data = padder.update(key_bytes) + padder.finalize()
+            random_iv = secrets.token_bytes(RANDOM_IV_SIZE)
+            cipher = Cipher(algorithms.AES(self.document_key), modes.CBC(random_iv), backend=default_backend())
+            encryptor = cipher.encryptor()
+            encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
+            cipher_data = random_iv + encrypted_data
+            encrypted_string = base64.b64encode(cipher_data).decode('utf-8')
+            self.insert_encrypted_value(secret, "http://www.w3.org/2001/04/xmlenc#aes256-cbc", encrypted_string)
+        else:
+            # PLAYREADY ONLY
+            if self.use_playready_content_key:
+                secret.append("{urn:ietf:params:xml:ns:keyprov:pskc}PlainValue", text=PLAYREADY_CONTENT_KEY)
             else:
-                plain_value = element_tree.SubElement(secret, "{urn:ietf:params:xml:ns:keyprov:pskc}PlainValue")
-                # PLAYREADY ONLY
-                if self.use_playready_content_key:
-                    plain_value.text = PLAYREADY_CONTENT_KEY
-                else:
-                    plain_value.text = base64.b64encode(key_bytes).decode('utf-8')
+                secret.append("{urn:ietf:params:xml:ns:keyprov:pskc}PlainValue", text=base64.b64encode(key_bytes).decode('utf-8'))
 
     def get_response(self):
         """
         Get the key request response as an HTTP response.
         """
-        self.fill_request()
+        body = self.write_response()
         if self.error_message:
             return {"isBase64Encoded": False, "statusCode": 500, "headers": {"Content-Type": "text/plain"}, "body": self.error_message}
         return {
@@ -243,106 +316,238 @@ class ServerResponseBuilder:
                 "Content-Type": "application/xml",
                 "Speke-User-Agent": "SPEKE Reference Server (https://github.com/awslabs/speke-reference-server)"
             },
-            "body": element_tree.tostring(self.root).decode('utf-8')
+            "body": body
         }
 
-    def insert_encrypted_value(self, element, encryption_algorithm, encrypted_string):
+    def write_response(self):
+        """
+        Fill the request and return the response document
+        """
+        if self.streaming:
+            return self.stream_request()
+        self.fill_request()
+        return self.writer.write(self.root)
+
+    def prescan_request(self):
+        """
+        Read what a streamed request needs before its first ContentKey is
+        filled: whether it has DeliveryData, and the DRMSystem key IDs that
+        decide the PlayReady content key and the SAMPLE-AES explicitIV
+        """
+        has_delivery_data = False
+        path = []
+        for event, element in STREAM_XML_BACKEND.iterparse(self.request_body):
+            if event == "start":
+                path.append(element)
+                continue
+            path.pop()
+            if len(path) == 2:
+                parent = path[-1]
+                if parent.tag == DELIVERY_DATA_LIST and element.tag == DELIVERY_DATA:
+                    has_delivery_data = True
+                elif parent.tag == DRM_SYSTEM_LIST and element.tag == DRM_SYSTEM:
+                    system_id = element.get("systemId")
+                    self.system_ids[system_id] = element.get("kid")
+                    if system_id.lower() == PLAYREADY_SYSTEM_ID:
+                        self.use_playready_content_key = True
+            if 1 <= len(path) <= 2:
+                path[-1].remove(element)
+        return has_delivery_data
+
+    def stream_request(self):
+        """
+        Fill and write a request while it is parsed. Only the elements
+        below the root lists are built, one at a time, and each is written
+        and released as soon as its tail is known; ContentKeys are held
+        back in chunks so their keys are derived and stored together.
+        """
+        if self.prescan_request():
+            print("ENCRYPTED-RESPONSE")
+            # generate a random document key and HMAC key
+            self.document_key = secrets.token_bytes(DOCUMENT_KEY_SIZE)
+            self.hmac_key = secrets.token_bytes(HMAC_KEY_SIZE)
+        else:
+            print("CLEAR-RESPONSE")
+        content_id = None
+        path = []
+        # root or list element whose start tag is not closed yet
+        opened = None
+        # list element whose tail is not written yet
+        closed = None
+        # (element, ContentKey or None) below the current list, not written yet
+        pending = []
+        for event, element in STREAM_XML_BACKEND.iterparse(self.request_body):
+            if event == "start":
+                depth = len(path)
+                path.append(element)
+            else:
+                path.pop()
+                depth = len(path)
+            if depth > 2 or (depth == 2 and event == "end"):
+                if depth == 2:
+                    pending.append(self.stream_element(path[-1], element, content_id))
+                continue
+            # the text of the opened element or the tails of the ended ones are known now
+            if opened is not None and event == "start":
+                self.writer.write_open_content(opened)
+                opened = None
+            if closed is not None:
+                self.writer.write_text(closed.tail)
+                self.writer.release(closed)
+                self.root.remove(closed)
+                closed = None
+            if pending and not (event == "start" and len(pending) < CPIX_STREAMING_CHUNK_SIZE):
+                self.flush_pending(path[-2] if event == "start" else element, pending, content_id)
+            if event == "start":
+                if depth == 0:
+                    self.root = element
+                    content_id = self.get_content_id()
+                if depth < 2:
+                    self.writer.write_open(element)
+                    opened = element
+            else:
+                self.writer.write_close(element, opened is not element)
+                opened = None
+                if depth == 1:
+                    closed = element
+        return self.writer.getvalue()
+
+    def stream_element(self, parent, element, content_id):
+        """
+        Fill an element below a root list of a streamed request, returning
+        it with its ContentKey when its key is still to be filled
+        """
+        if parent.tag == DELIVERY_DATA_LIST and element.tag == DELIVERY_DATA:
+            self.fill_delivery_data(DeliveryData(element, STREAM_XML_BACKEND.certificate(element)))
+        elif parent.tag == DRM_SYSTEM_LIST and element.tag == DRM_SYSTEM:
+            self.fill_drm_system(DRMSystem(element), content_id)
+        elif parent.tag == CONTENT_KEY_LIST and element.tag == CONTENT_KEY:
+            return element, ContentKey(element)
+        return element, None
+
+    def flush_pending(self, parent, pending, content_id):
+        """
+        Fill the held back ContentKeys of a streamed request, then write
+        and release the held back elements with their tails
+        """
+        content_keys = [content_key for _, content_key in pending if content_key is not None]
+        if content_keys:
+            keys = self.cache.store_many(content_id, self.generator.iter_keys(content_id, [content_key.kid for content_key in content_keys]))
+        for element, content_key in pending:
+            if content_key is not None:
+                self.fill_content_key(content_key, content_id, keys[content_key.kid])
+            self.writer.write_element(element)
+            self.writer.write_text(element.tail)
+            self.writer.release(element)
+            parent.remove(element)
+            element.clear()
+        del pending[:]
+        self.writer.compact()
+
+    def insert_encrypted_value(self, node, encryption_algorithm, encrypted_string):
         """
         Add an encrypted value (key) to the document.
         """
-        encrypted_value = element_tree.SubElement(element, "{urn:ietf:params:xml:ns:keyprov:pskc}EncryptedValue")
-        encryption_method = element_tree.SubElement(encrypted_value, "{http://www.w3.org/2001/04/xmlenc#}EncryptionMethod")
-        encryption_method.set("Algorithm", encryption_algorithm)
-        cipher_data = element_tree.SubElement(encrypted_value, "{http://www.w3.org/2001/04/xmlenc#}CipherData")
-        cipher_value = element_tree.SubElement(cipher_data, "{http://www.w3.org/2001/04/xmlenc#}CipherValue")
-        cipher_value.text = encrypted_string
+        encrypted_value = node.append("{urn:ietf:params:xml:ns:keyprov:pskc}EncryptedValue")
+        encrypted_value.append("{http://www.w3.org/2001/04/xmlenc#}EncryptionMethod", [("Algorithm", encryption_algorithm)])
+        cipher_data = encrypted_value.append("{http://www.w3.org/2001/04/xmlenc#}CipherData")
+        cipher_data.append("{http://www.w3.org/2001/04/xmlenc#}CipherValue", text=encrypted_string)
         # calculate and set MAC using HMAC-SHA512 over data in CipherValue
         if not self.hmac_key:
             raise Exception("Missing HMAC key")
-        value_mac = element_tree.SubElement(element, "{urn:ietf:params:xml:ns:keyprov:pskc}ValueMAC")
         hmac_instance = hmac.HMAC(self.hmac_key, hashes.SHA512(), backend=default_backend())
         hmac_instance.update(base64.b64decode(encrypted_string))
-        value_mac.text = base64.b64encode(hmac_instance.finalize()).decode('utf-8')
+        node.append("{urn:ietf:params:xml:ns:keyprov:pskc}ValueMAC", text=base64.b64encode(hmac_instance.finalize()).decode('utf-8'))
 
-    def safe_remove(self, element, match):
+    def safe_remove(self, drm_system, match):
         """
         Helper to remove an element only if it exists.
         """
-        if element.find(match):
-            element.remove(match)
+        child = drm_system.children.get(match)
+        # the test has always been the truth value of the element, so elements without children are kept
+        if child is not None and len(child):
+            self.writer.remove(child)
 
 class ServerResponseBuilderV2(ServerResponseBuilder):
     def get_content_id(self):
         return self.root.get("contentId")
 
-    def fixup_document(self, drm_system, system_id, content_id, kid):
+    def is_hls_aes_128_rotation(self):
+        """
+        SPEKE v2 has no HLS AES-128 system ID, so there is no fast path
+        """
+        return False
+
+    def fixup_document(self, drm_system, content_id):
         """
         Update the returned XML document based on the specified system ID
         """
+        # the system ID constants are lower case
+        system_id = drm_system.system_id_lower
         # DRMSystem for WIDEVINE_SYSTEM_ID
-        if system_id.lower() == DASH_CENC_SYSTEM_ID.lower():
-            pssh_box = drm_system.find("{urn:dashif:org:cpix}PSSH")
+        if system_id == DASH_CENC_SYSTEM_ID:
+            pssh_box = drm_system.children.get("{urn:dashif:org:cpix}PSSH")
             if pssh_box is not None:
-                pssh_box.text = WIDEVINE_PSSH_BOX
-            
-            content_protection_data = drm_system.find("{urn:dashif:org:cpix}ContentProtectionData")
+                self.writer.set_text(pssh_box, WIDEVINE_PSSH_BOX)
+
+            content_protection_data = drm_system.children.get("{urn:dashif:org:cpix}ContentProtectionData")
             if content_protection_data is not None:
-                content_protection_data.text = WIDEVINE_CONTENT_PROTECTION_DATA
+                self.writer.set_text(content_protection_data, WIDEVINE_CONTENT_PROTECTION_DATA)
 
-            hls_signalling_data_elems = drm_system.findall("{urn:dashif:org:cpix}HLSSignalingData")
-            if hls_signalling_data_elems:
-                drm_system.find("{urn:dashif:org:cpix}HLSSignalingData[@playlist='media']").text = WIDEVINE_HLS_SIGNALING_DATA_MEDIA
-                drm_system.find("{urn:dashif:org:cpix}HLSSignalingData[@playlist='master']").text = WIDEVINE_HLS_SIGNALING_DATA_MASTER
+            self.fill_hls_signaling_data(drm_system, WIDEVINE_HLS_SIGNALING_DATA_MEDIA, WIDEVINE_HLS_SIGNALING_DATA_MASTER)
 
         # DRMSystem for PLAYREADY_SYSTEM_ID
-        elif system_id.lower() == PLAYREADY_SYSTEM_ID.lower():
-            pssh_box = drm_system.find("{urn:dashif:org:cpix}PSSH")
+        elif system_id == PLAYREADY_SYSTEM_ID:
+            pssh_box = drm_system.children.get("{urn:dashif:org:cpix}PSSH")
             if pssh_box is not None:
-                pssh_box.text = PLAYREADY_PSSH_BOX
+                self.writer.set_text(pssh_box, PLAYREADY_PSSH_BOX)
 
-            content_protection_data = drm_system.find("{urn:dashif:org:cpix}ContentProtectionData")
+            content_protection_data = drm_system.children.get("{urn:dashif:org:cpix}ContentProtectionData")
             if content_protection_data is not None:
-                content_protection_data.text = PLAYREADY_CONTENT_PROTECTION_DATA
-            
-            hls_signalling_data_elems = drm_system.findall("{urn:dashif:org:cpix}HLSSignalingData")
-            if hls_signalling_data_elems:
-                drm_system.find("{urn:dashif:org:cpix}HLSSignalingData[@playlist='media']").text = PLAYREADY_HLS_SIGNALING_DATA_MEDIA
-                drm_system.find("{urn:dashif:org:cpix}HLSSignalingData[@playlist='master']").text = PLAYREADY_HLS_SIGNALING_DATA_MASTER
-            
+                self.writer.set_text(content_protection_data, PLAYREADY_CONTENT_PROTECTION_DATA)
+
+            self.fill_hls_signaling_data(drm_system, PLAYREADY_HLS_SIGNALING_DATA_MEDIA, PLAYREADY_HLS_SIGNALING_DATA_MASTER)
+
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}SmoothStreamingProtectionHeaderData")
             self.use_playready_content_key = True
 
         # DRMSystem for FAIRPLAY_SYSTEM_ID
-        elif system_id.lower() == HLS_SAMPLE_AES_SYSTEM_ID.lower():
+        elif system_id == HLS_SAMPLE_AES_SYSTEM_ID:
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}ContentProtectionData")
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}PSSH")
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}SmoothStreamingProtectionHeaderData")
-            hls_signalling_data_elems = drm_system.findall("{urn:dashif:org:cpix}HLSSignalingData")
-            if hls_signalling_data_elems:
-                drm_system.find("{urn:dashif:org:cpix}HLSSignalingData[@playlist='media']").text = FAIRPLAY_HLS_SIGNALING_DATA_MEDIA
-                drm_system.find("{urn:dashif:org:cpix}HLSSignalingData[@playlist='master']").text = FAIRPLAY_HLS_SIGNALING_DATA_MASTER
+            self.fill_hls_signaling_data(drm_system, FAIRPLAY_HLS_SIGNALING_DATA_MEDIA, FAIRPLAY_HLS_SIGNALING_DATA_MASTER)
 
-        elif system_id.lower() == CLEAR_KEY_AES_128_SYSTEM_ID.lower():
-            ext_x_key_uri = self.cache.url(content_id, kid)
+        elif system_id == CLEAR_KEY_AES_128_SYSTEM_ID:
+            ext_x_key_uri = self.cache.url(content_id, drm_system.kid)
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}ContentProtectionData")
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}PSSH")
             self.safe_remove(drm_system, "{urn:dashif:org:cpix}SmoothStreamingProtectionHeaderData")
 
             ext_x_session_key, ext_x_key = self.clearkey_aes_128_hls_signaling_data(ext_x_key_uri)
 
-            hls_signalling_data_elems = drm_system.findall("{urn:dashif:org:cpix}HLSSignalingData")
-            if hls_signalling_data_elems:
-                drm_system.find("{urn:dashif:org:cpix}HLSSignalingData[@playlist='media']").text = ext_x_key
-                drm_system.find("{urn:dashif:org:cpix}HLSSignalingData[@playlist='master']").text = ext_x_session_key
+            self.fill_hls_signaling_data(drm_system, ext_x_key, ext_x_session_key)
 
         else:
-            raise Exception("Invalid system ID {}".format(system_id))
+            raise Exception("Invalid system ID {}".format(drm_system.system_id))
+
+    def fill_hls_signaling_data(self, drm_system, media, master):
+        """
+        Set the media and master playlist HLSSignalingData of a DRMSystem, if it has any
+        """
+        if drm_system.children.get("{urn:dashif:org:cpix}HLSSignalingData") is None:
+            return
+        for playlist, text in (("media", media), ("master", master)):
+            hls_signaling_data = drm_system.hls_signaling_data.get(playlist)
+            if hls_signaling_data is None:
+                raise Exception("Missing {} HLSSignalingData in DRMSystem {}".format(playlist, drm_system.system_id))
+            self.writer.set_text(hls_signaling_data, text)
 
     def get_response(self):
         """
         Get the key request response as an HTTP response.
         """
-        self.fill_request()
+        body = self.write_response()
         if self.error_message:
             return {"isBase64Encoded": False, "statusCode": 500, "headers": {"Content-Type": "text/plain"}, "body": self.error_message}
         return {
@@ -353,7 +558,7 @@ class ServerResponseBuilderV2(ServerResponseBuilder):
                 "X-Speke-User-Agent": "SPEKE Reference Server (https://github.com/awslabs/speke-reference-server)",
                 "X-Speke-Version": "2.0"
             },
-            "body": element_tree.tostring(self.root).decode('utf-8')
+            "body": body
         }
 
     def clearkey_aes_128_hls_signaling_data(self, ext_x_key_uri):
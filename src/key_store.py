@@ -0,0 +1,493 @@
+"""
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import hashlib
+import hmac
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote, unquote
+
+from aws_clients import get_client
+from botocore.exceptions import ClientError
+
+# key storage, "s3", "filesystem", "dynamodb", "memory" or "derive" (nothing stored);
+# dynamodb and derive keys are served by client_handler, which KEYSTORE_URL must point at
+KEYSTORE_BACKEND = os.environ.get("KEYSTORE_BACKEND", "s3")
+KEYSTORE_BUCKET = os.environ.get("KEYSTORE_BUCKET", "")
+# S3 object layout, "legacy" ({content_id}/{kid}) or "hashed" ({hash}/{content_id}/{kid})
+KEYSTORE_LAYOUT = os.environ.get("KEYSTORE_LAYOUT", "legacy")
+KEYSTORE_HASH_PREFIX_LENGTH = int(os.environ.get("KEYSTORE_HASH_PREFIX_LENGTH", "4"))
+KEYSTORE_PATH = os.environ.get("KEYSTORE_PATH", "/var/lib/speke/keys")
+KEYSTORE_TABLE = os.environ.get("KEYSTORE_TABLE", "")
+# days before DynamoDB removes a key item through its expires_at TTL attribute, 0 to keep keys
+KEYSTORE_RETENTION_DAYS = int(os.environ.get("KEYSTORE_RETENTION_DAYS", "2"))
+# set to a DynamoDB Local endpoint such as http://localhost:8000 for testing
+DYNAMODB_ENDPOINT_URL = os.environ.get("DYNAMODB_ENDPOINT_URL") or None
+
+# number of keys kept by the derive key store for repeated retrievals
+DERIVED_KEY_CACHE_MAX = int(os.environ.get("DERIVED_KEY_CACHE_MAX", "10000"))
+# content IDs without a secret are not looked up again for this long, like the caching of missing keys
+DERIVED_KEY_MISSING_TTL_SECONDS = int(os.environ.get("DERIVED_KEY_MISSING_TTL_SECONDS", "10"))
+
+# keys never change once written, so players and CDNs may cache them indefinitely
+KEY_CACHE_CONTROL = "public, max-age=31536000, immutable"
+KEY_CONTENT_TYPE = "application/octet-stream"
+
+# DeleteObjects accepts at most 1000 keys per call
+S3_DELETE_BATCH_SIZE = 1000
+# BatchWriteItem accepts at most 25 items per call
+DYNAMODB_BATCH_SIZE = 25
+DYNAMODB_BATCH_ATTEMPTS = 8
+
+
+def legacy_key_location(content_id, key_id):
+    """
+    Return the original {content_id}/{kid} location of a key
+    """
+    return "{cid}/{kid}".format(cid=content_id, kid=key_id)
+
+
+def hashed_key_location(content_id, key_id, prefix_length=KEYSTORE_HASH_PREFIX_LENGTH):
+    """
+    Return a {hash}/{content_id}/{kid} location of a key, where the hash
+    prefix spreads the keys of one content ID over many S3 prefixes
+    """
+    prefix = hashlib.md5("{}/{}".format(content_id, key_id).encode('utf-8')).hexdigest()[:prefix_length]
+    return "{}/{}".format(prefix, legacy_key_location(content_id, key_id))
+
+
+def parse_key_location(location):
+    """
+    Return the content ID and key ID of a legacy or hashed key location
+    """
+    parts = location.split("/")
+    # a hashed location is only recognized when its prefix matches the hash
+    if len(parts) >= 3 and hashed_key_location("/".join(parts[1:-1]), parts[-1], len(parts[0])) == location:
+        return "/".join(parts[1:-1]), parts[-1]
+    return "/".join(parts[:-1]), parts[-1]
+
+
+def split_shards(items, count):
+    """
+    Deal items round-robin into at most count non-empty shards
+    """
+    shards = [items[index::count] for index in range(count)]
+    return [shard for shard in shards if shard]
+
+
+class S3KeyStore:
+    """
+    This class is responsible for storing keys as objects in an S3 bucket
+    using the content ID as a folder and the key ID as the file, optionally
+    below a short hash prefix so busy content IDs are spread over many
+    S3 prefixes and their request rate limits.
+    """
+
+    batch_size = 1
+
+    def __init__(self, bucket, s3_client=None, layout="legacy"):
+        self.bucket = bucket
+        self.layout = layout
+        self.s3_client = s3_client if s3_client is not None else get_client('s3')
+
+    def location(self, content_id, key_id):
+        """
+        Return the object key of a key, relative to the key URL prefix
+        """
+        if self.layout == "hashed":
+            return hashed_key_location(content_id, key_id)
+        return legacy_key_location(content_id, key_id)
+
+    def locations(self, content_id, key_id):
+        """
+        Return every object key a key may be stored under, current layout first
+        """
+        location = self.location(content_id, key_id)
+        legacy_location = legacy_key_location(content_id, key_id)
+        return [location] if location == legacy_location else [location, legacy_location]
+
+    def put(self, content_id, key_id, key_value):
+        """
+        Store a key object
+        """
+        # store the key file with public-read permissions
+        # public bucket policy not required
+        # the caching metadata is returned by S3 and passed on by CloudFront
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.location(content_id, key_id), Body=key_value, CacheControl=KEY_CACHE_CONTROL, ContentType=KEY_CONTENT_TYPE)
+
+    def read(self, location):
+        """
+        Return the body of a key object, or None if there is none
+        """
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=location)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise error
+        return response['Body'].read()
+
+    def get(self, content_id, key_id):
+        """
+        Return a stored key from the current or legacy layout, or None if there is none
+        """
+        for location in self.locations(content_id, key_id):
+            key_value = self.read(location)
+            if key_value is not None:
+                return key_value
+        return None
+
+    def scan_shards(self, count):
+        """
+        Split the top level prefixes of the bucket (content IDs or hash
+        prefixes) into at most count shards that can be scanned in parallel
+        """
+        prefixes = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Delimiter="/"):
+            prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+        return split_shards(prefixes, count)
+
+    def scan(self, shard):
+        """
+        Yield the content ID and location of every key below the prefixes of a shard
+        """
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for prefix in shard:
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                for key_object in page.get('Contents', []):
+                    location = key_object['Key']
+                    yield parse_key_location(location)[0], location
+
+    def delete(self, locations):
+        """
+        Delete key objects in batches of up to 1000, returning the locations that could not be deleted
+        """
+        failed = []
+        for start in range(0, len(locations), S3_DELETE_BATCH_SIZE):
+            batch = locations[start:start + S3_DELETE_BATCH_SIZE]
+            response = self.s3_client.delete_objects(Bucket=self.bucket, Delete={"Objects": [{"Key": location} for location in batch], "Quiet": True})
+            for error in response.get('Errors', []):
+                print("DELETE-KEY-FAILED {} {}".format(error['Key'], error.get('Code')))
+                failed.append(error['Key'])
+        return failed
+
+
+class FileKeyStore:
+    """
+    This class is responsible for storing keys as files below a local
+    folder that can be served by an HTTP origin. Content ID folders are
+    spread over 256 shard folders so no single folder grows too large,
+    and every file is written atomically.
+    """
+
+    batch_size = 1
+
+    def __init__(self, root):
+        self.root = root
+
+    def location(self, content_id, key_id):
+        """
+        Return the path of a key relative to the root folder and key URL prefix
+        """
+        # quoting leaves no "/", and "." and ".." (or an empty name) would name another folder
+        for name in (content_id, key_id):
+            if name in ("", ".", ".."):
+                raise Exception("Invalid content or key ID {!r} for the filesystem key store".format(name))
+        folder = quote(content_id, safe='')
+        shard = hashlib.sha256(content_id.encode('utf-8')).hexdigest()[:2]
+        return "{}/{}/{}".format(shard, folder, quote(key_id, safe=''))
+
+    def put(self, content_id, key_id, key_value):
+        """
+        Write a key file through a temporary file in the same folder and an atomic rename
+        """
+        path = os.path.join(self.root, self.location(content_id, key_id))
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(dir=folder, prefix='.tmp-')
+        try:
+            with os.fdopen(descriptor, 'wb') as key_file:
+                key_file.write(key_value)
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    def get(self, content_id, key_id):
+        """
+        Return a stored key, or None if there is none
+        """
+        try:
+            with open(os.path.join(self.root, self.location(content_id, key_id)), 'rb') as key_file:
+                return key_file.read()
+        except FileNotFoundError:
+            return None
+
+    def scan_shards(self, count):
+        """
+        Split the shard folders into at most count shards that can be scanned in parallel
+        """
+        try:
+            folders = sorted(entry.name for entry in os.scandir(self.root) if entry.is_dir())
+        except FileNotFoundError:
+            return []
+        return split_shards(folders, count)
+
+    def scan(self, shard):
+        """
+        Yield the content ID and location of every key file below the folders of a shard
+        """
+        for folder in shard:
+            for content_folder in os.scandir(os.path.join(self.root, folder)):
+                if not content_folder.is_dir():
+                    continue
+                content_id = unquote(content_folder.name)
+                for key_file in os.scandir(content_folder.path):
+                    # skip the temporary files of writes in progress
+                    if key_file.name.startswith('.tmp-'):
+                        continue
+                    yield content_id, "{}/{}/{}".format(folder, content_folder.name, key_file.name)
+
+    def delete(self, locations):
+        """
+        Delete key files and the content ID folders left empty, returning the locations that could not be deleted
+        """
+        failed = []
+        folders = set()
+        for location in locations:
+            path = os.path.join(self.root, location)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                print("DELETE-KEY-FAILED {} {}".format(location, error))
+                failed.append(location)
+            folders.add(os.path.dirname(path))
+        for folder in folders:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                # a key was written since the scan
+                pass
+        return failed
+
+
+class DynamoDbKeyStore:
+    """
+    This class is responsible for storing keys as items in a DynamoDB
+    table with content_id as the partition key and kid as the sort key.
+    Keys of one request are written with BatchWriteItem, and each item
+    carries an expires_at time for the table's TTL, like the lifecycle
+    rule of the key bucket.
+    """
+
+    batch_size = DYNAMODB_BATCH_SIZE
+
+    def __init__(self, table_name, dynamodb_client=None, retention_days=KEYSTORE_RETENTION_DAYS):
+        self.table_name = table_name
+        self.retention_days = retention_days
+        self.dynamodb_client = dynamodb_client if dynamodb_client is not None else get_client('dynamodb', DYNAMODB_ENDPOINT_URL)
+
+    def location(self, content_id, key_id):
+        """
+        Return the path of a key relative to the key URL prefix (the key retrieval route)
+        """
+        return "{}/{}".format(quote(content_id, safe=''), quote(key_id, safe=''))
+
+    def item(self, content_id, key_id, key_value):
+        """
+        Return the DynamoDB item for a key
+        """
+        item = {"content_id": {"S": content_id}, "kid": {"S": key_id}, "key": {"B": key_value}}
+        if self.retention_days > 0:
+            item["expires_at"] = {"N": str(int(time.time()) + self.retention_days * 86400)}
+        return item
+
+    def put(self, content_id, key_id, key_value):
+        """
+        Store a key item
+        """
+        self.dynamodb_client.put_item(TableName=self.table_name, Item=self.item(content_id, key_id, key_value))
+
+    def put_many(self, content_id, keys):
+        """
+        Store up to 25 (key_id, key_value) pairs in one BatchWriteItem call,
+        retrying unprocessed items with exponential backoff
+        """
+        request_items = {self.table_name: [{"PutRequest": {"Item": self.item(content_id, key_id, key_value)}} for key_id, key_value in keys]}
+        for attempt in range(DYNAMODB_BATCH_ATTEMPTS):
+            response = self.dynamodb_client.batch_write_item(RequestItems=request_items)
+            request_items = response.get('UnprocessedItems')
+            if not request_items:
+                return
+            print("UNPROCESSED-KEYS {} {}".format(content_id, len(request_items.get(self.table_name, []))))
+            time.sleep(min(0.05 * 2**attempt, 1.0))
+        raise Exception("Unable to store {} keys for content ID {}".format(len(request_items.get(self.table_name, [])), content_id))
+
+    def get(self, content_id, key_id):
+        """
+        Return a stored key, or None if there is none
+        """
+        # players fetch a key right after the SPEKE response, before an eventually consistent read would see it
+        response = self.dynamodb_client.get_item(TableName=self.table_name, Key={"content_id": {"S": content_id}, "kid": {"S": key_id}}, ConsistentRead=True)
+        item = response.get('Item')
+        if item is None:
+            return None
+        return item['key']['B']
+
+
+class MemoryKeyStore:
+    """
+    This class is responsible for storing keys in process memory, for
+    tests and benchmarks.
+    """
+
+    batch_size = 1
+
+    def __init__(self):
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def location(self, content_id, key_id):
+        """
+        Return the location of a key relative to the key URL prefix
+        """
+        return "{cid}/{kid}".format(cid=content_id, kid=key_id)
+
+    def put(self, content_id, key_id, key_value):
+        """
+        Store a key
+        """
+        with self.lock:
+            self.keys[(content_id, key_id)] = key_value
+
+    def get(self, content_id, key_id):
+        """
+        Return a stored key, or None if there is none
+        """
+        return self.keys.get((content_id, key_id))
+
+
+class DerivedKeyStore:
+    """
+    This class is responsible for serving keys without storing them.
+    Keys are a function of the content ID secret and the key ID, so a
+    retrieval derives the key again through the key generator. Recently
+    retrieved keys are kept in a bounded LRU, and content IDs without a
+    secret are remembered for a short while so unauthenticated retrievals
+    of unknown content IDs do not each reach the secret backend.
+
+    In root key mode every content ID has a secret, so key URLs carry a
+    token signed with the root secret and retrievals without a valid token
+    are refused.
+
+    Nothing is written to the key bucket, so KEYSTORE_URL must point at
+    the key retrieval route (client_handler), not at the bucket.
+    """
+
+    batch_size = 1
+    # the key cache skips writes entirely for this store
+    stores_keys = False
+
+    def __init__(self, generator, max_entries=DERIVED_KEY_CACHE_MAX):
+        self.generator = generator
+        self.max_entries = max_entries
+        self.keys = OrderedDict()
+        # content IDs by the time their secret was found missing
+        self.missing = OrderedDict()
+        self.missing_ttl = DERIVED_KEY_MISSING_TTL_SECONDS
+        self.lock = threading.Lock()
+
+    def token(self, content_id, key_id):
+        """
+        Return the token of a key URL, or None when the secret backend does not sign key URLs
+        """
+        url_token = getattr(self.generator.secret_backend, 'url_token', None)
+        if url_token is None:
+            return None
+        return url_token(content_id, key_id)
+
+    def location(self, content_id, key_id):
+        """
+        Return the path of a key relative to the key URL prefix (the key retrieval route)
+        """
+        location = "{}/{}".format(quote(content_id, safe=''), quote(key_id, safe=''))
+        token = self.token(content_id, key_id)
+        if token is not None:
+            location = "{}?token={}".format(location, token)
+        return location
+
+    def authorize(self, content_id, key_id, token):
+        """
+        Check the token of a key retrieval against the one in the key URL issued for it
+        """
+        expected = self.token(content_id, key_id)
+        return expected is None or (token is not None and hmac.compare_digest(expected, token))
+
+    def put(self, content_id, key_id, key_value):
+        """
+        Nothing is stored, the key is derived again when it is retrieved
+        """
+
+    def get(self, content_id, key_id):
+        """
+        Return the key for a content ID and key ID, or None if the content ID has no secret
+        """
+        with self.lock:
+            key_value = self.keys.get((content_id, key_id))
+            if key_value is not None:
+                self.keys.move_to_end((content_id, key_id))
+                return key_value
+            missing = self.missing.get(content_id)
+            if missing is not None and time.monotonic() - missing < self.missing_ttl:
+                return None
+        # never create a secret for a content ID that was not requested by an encryptor
+        if not self.generator.prefetch_content_id_secret(content_id):
+            with self.lock:
+                self.missing[content_id] = time.monotonic()
+                self.missing.move_to_end(content_id)
+                while len(self.missing) > self.max_entries:
+                    self.missing.popitem(last=False)
+            return None
+        key_value = self.generator.key(content_id, key_id)
+        with self.lock:
+            self.keys[(content_id, key_id)] = key_value
+            while len(self.keys) > self.max_entries:
+                self.keys.popitem(last=False)
+        return key_value
+
+
+def create_key_store(name=None, generator=None):
+    """
+    Create the key store selected by name or the KEYSTORE_BACKEND setting
+    """
+    name = name or KEYSTORE_BACKEND
+    if name == "derive":
+        return DerivedKeyStore(generator)
+    if name == "s3":
+        if not KEYSTORE_BUCKET:
+            raise Exception("KEYSTORE_BUCKET is required for the s3 key store")
+        return S3KeyStore(KEYSTORE_BUCKET, layout=KEYSTORE_LAYOUT)
+    if name == "filesystem":
+        return FileKeyStore(KEYSTORE_PATH)
+    if name == "dynamodb":
+        if not KEYSTORE_TABLE:
+            raise Exception("KEYSTORE_TABLE is required for the dynamodb key store")
+        return DynamoDbKeyStore(KEYSTORE_TABLE)
+    if name == "memory":
+        return MemoryKeyStore()
+    raise Exception("Invalid key store {}".format(name))
@@ -0,0 +1,490 @@
+"""
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from aws_clients import get_client
+from botocore.exceptions import ClientError
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# content ID secret storage, "secretsmanager", "sqlite", "memory" or "rootkey"
+SECRET_BACKEND = os.environ.get("SECRET_BACKEND", "secretsmanager")
+SECRET_SQLITE_PATH = os.environ.get("SECRET_SQLITE_PATH", "/tmp/speke-secrets.db")
+# root key mode, the root secret is read once from Secrets Manager or a file
+ROOT_KEY_SECRET_ID = os.environ.get("ROOT_KEY_SECRET_ID", "speke-root")
+ROOT_KEY_FILE = os.environ.get("ROOT_KEY_FILE", "")
+# backend still holding secrets created before root key mode was enabled, the previous
+# default so existing content IDs keep their keys; "none" only for deployments that
+# never stored a per content ID secret
+ROOT_KEY_LEGACY_BACKEND = os.environ.get("ROOT_KEY_LEGACY_BACKEND", "secretsmanager")
+# list of the content IDs with a legacy secret, s3://bucket/key or a file path, written by
+# running this module once every server is in root key mode; only those content IDs are
+# looked up in the legacy backend, every other one is derived without any network call.
+# It names content IDs, so keep it out of the publicly readable key bucket
+ROOT_KEY_LEGACY_MANIFEST = os.environ.get("ROOT_KEY_LEGACY_MANIFEST", "")
+ROOT_KEY_MINIMUM_LENGTH = 32
+# days a deleted Secrets Manager secret can still be restored, 7 to 30
+SECRET_DELETION_RECOVERY_DAYS = int(os.environ.get("SECRET_DELETION_RECOVERY_DAYS", "30"))
+# secret access times are kept to the day, like Secrets Manager's LastAccessedDate
+SECRET_ACCESS_RESOLUTION_SECONDS = 86400
+
+
+def is_scheduled_for_deletion(error):
+    """
+    Check whether a Secrets Manager error was caused by a secret scheduled for deletion
+    """
+    error = error.response['Error']
+    return error['Code'] == 'InvalidRequestException' and 'deletion' in error.get('Message', '')
+
+
+class SecretsManagerBackend:
+    """
+    This class is responsible for storing content ID secrets in
+    AWS Secrets Manager as speke/<content_id>.
+    """
+
+    # secrets are remote, so keep a copy in the local folder
+    cache_locally = True
+
+    def __init__(self, secrets_client=None):
+        self.secrets_client = secrets_client if secrets_client is not None else get_client('secretsmanager')
+
+    def secret_id(self, content_id):
+        """
+        Return the Secrets Manager secret ID for a content ID
+        """
+        return "speke/{}".format(content_id)
+
+    def get(self, content_id):
+        """
+        Return the secret for a content ID, or None if there is none
+        """
+        try:
+            response = self.secrets_client.get_secret_value(SecretId=self.secret_id(content_id))
+        except ClientError as error:
+            # a secret scheduled for deletion by the garbage collector is gone, not unavailable
+            if error.response['Error']['Code'] == 'ResourceNotFoundException' or is_scheduled_for_deletion(error):
+                return None
+            raise error
+        return response['SecretString']
+
+    def create(self, content_id, secret):
+        """
+        Store a new secret for a content ID and return the stored value,
+        which is the existing value if another process created it first
+        """
+        try:
+            self.secrets_client.create_secret(Name=self.secret_id(content_id), SecretString=secret, Description='SPEKE content ID secret value for key generation')
+        except ClientError as error:
+            if is_scheduled_for_deletion(error):
+                raise Exception("The secret for content ID {} is scheduled for deletion, a garbage collected content ID cannot be used again".format(content_id))
+            if error.response['Error']['Code'] != 'ResourceExistsException':
+                raise error
+            # another invocation won the race, use its value
+            print("CREATE-SECRET-CONFLICT {}".format(content_id))
+            return self.secrets_client.get_secret_value(SecretId=self.secret_id(content_id))['SecretString']
+        return secret
+
+    def delete(self, content_id):
+        """
+        Schedule the secret for a content ID for deletion, returning False if there is none
+        """
+        try:
+            self.secrets_client.delete_secret(SecretId=self.secret_id(content_id), RecoveryWindowInDays=SECRET_DELETION_RECOVERY_DAYS)
+        except ClientError as error:
+            # InvalidRequestException means the secret is already scheduled for deletion
+            if error.response['Error']['Code'] in ('ResourceNotFoundException', 'InvalidRequestException'):
+                return False
+            raise error
+        return True
+
+    def secrets(self):
+        """
+        Yield the content ID and last access time of every stored secret,
+        not counting secrets already scheduled for deletion
+        """
+        paginator = self.secrets_client.get_paginator('list_secrets')
+        for page in paginator.paginate(Filters=[{"Key": "name", "Values": ["speke/"]}]):
+            for secret in page.get('SecretList', []):
+                # the name filter is a case insensitive prefix match
+                if not secret['Name'].startswith("speke/"):
+                    continue
+                yield secret['Name'][len("speke/"):], self.access_time(secret)
+
+    def access_time(self, secret):
+        """
+        Return the last access time of a listed or described secret, its
+        creation time if it has never been read
+        """
+        return (secret.get('LastAccessedDate') or secret['CreatedDate']).timestamp()
+
+    def content_ids(self):
+        """
+        Yield the content ID of every stored secret
+        """
+        for content_id, _ in self.secrets():
+            yield content_id
+
+    def idle_content_ids(self, cutoff):
+        """
+        Yield the content IDs whose secret has not been read since the cutoff time
+        """
+        for content_id, accessed in self.secrets():
+            if accessed < cutoff:
+                yield content_id
+
+    def last_accessed(self, content_id):
+        """
+        Return the last access time of the secret for a content ID, or None if there is none
+        """
+        try:
+            secret = self.secrets_client.describe_secret(SecretId=self.secret_id(content_id))
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'ResourceNotFoundException':
+                return None
+            raise error
+        if secret.get('DeletedDate') is not None:
+            return None
+        return self.access_time(secret)
+
+    def random_password(self, length):
+        """
+        Return a random password generated by Secrets Manager
+        """
+        return self.secrets_client.get_random_password(PasswordLength=length)['RandomPassword']
+
+
+class SqliteSecretBackend:
+    """
+    This class is responsible for storing content ID secrets in a local
+    SQLite database that can be shared by many worker processes. Reads
+    update a per-secret access time once a day, for garbage collection.
+    """
+
+    cache_locally = False
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        connection = self.connection()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS content_id_secrets (content_id TEXT PRIMARY KEY, secret TEXT NOT NULL, created REAL NOT NULL, accessed REAL) WITHOUT ROWID")
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(content_id_secrets)")]
+            if "accessed" not in columns:
+                # databases created before access times were kept
+                connection.execute("ALTER TABLE content_id_secrets ADD COLUMN accessed REAL")
+
+    def connection(self):
+        """
+        Return the database connection for the calling thread
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            # WAL lets readers in other processes continue while one process writes
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def get(self, content_id):
+        """
+        Return the secret for a content ID, or None if there is none
+        """
+        connection = self.connection()
+        row = connection.execute("SELECT secret, coalesce(accessed, created) FROM content_id_secrets WHERE content_id = ?", (content_id, )).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] >= SECRET_ACCESS_RESOLUTION_SECONDS:
+            connection.execute("UPDATE content_id_secrets SET accessed = ? WHERE content_id = ?", (now, content_id))
+        return row[0]
+
+    def create(self, content_id, secret):
+        """
+        Store a new secret for a content ID and return the stored value,
+        which is the existing value if another process created it first
+        """
+        connection = self.connection()
+        connection.execute("INSERT OR IGNORE INTO content_id_secrets (content_id, secret, created) VALUES (?, ?, ?)", (content_id, secret, time.time()))
+        return self.get(content_id)
+
+    def content_ids(self):
+        """
+        Yield the content ID of every stored secret
+        """
+        for row in self.connection().execute("SELECT content_id FROM content_id_secrets"):
+            yield row[0]
+
+    def idle_content_ids(self, cutoff):
+        """
+        Yield the content IDs whose secret has not been read since the cutoff time
+        """
+        for row in self.connection().execute("SELECT content_id FROM content_id_secrets WHERE coalesce(accessed, created) < ?", (cutoff, )):
+            yield row[0]
+
+    def last_accessed(self, content_id):
+        """
+        Return the last access time of the secret for a content ID, or None if there is none
+        """
+        row = self.connection().execute("SELECT coalesce(accessed, created) FROM content_id_secrets WHERE content_id = ?", (content_id, )).fetchone()
+        return row[0] if row else None
+
+    def delete(self, content_id):
+        """
+        Delete the secret for a content ID, returning False if there is none
+        """
+        return self.connection().execute("DELETE FROM content_id_secrets WHERE content_id = ?", (content_id, )).rowcount > 0
+
+
+class MemorySecretBackend:
+    """
+    This class is responsible for storing content ID secrets in process
+    memory, for tests and benchmarks.
+    """
+
+    cache_locally = False
+
+    def __init__(self):
+        self.secrets = {}
+        self.accessed = {}
+        self.lock = threading.Lock()
+
+    def get(self, content_id):
+        """
+        Return the secret for a content ID, or None if there is none
+        """
+        with self.lock:
+            secret = self.secrets.get(content_id)
+            if secret is not None:
+                self.accessed[content_id] = time.time()
+            return secret
+
+    def create(self, content_id, secret):
+        """
+        Store a new secret for a content ID and return the stored value
+        """
+        with self.lock:
+            self.accessed.setdefault(content_id, time.time())
+            return self.secrets.setdefault(content_id, secret)
+
+    def delete(self, content_id):
+        """
+        Delete the secret for a content ID, returning False if there is none
+        """
+        with self.lock:
+            self.accessed.pop(content_id, None)
+            return self.secrets.pop(content_id, None) is not None
+
+    def content_ids(self):
+        """
+        Yield the content ID of every stored secret
+        """
+        with self.lock:
+            content_ids = list(self.secrets)
+        return iter(content_ids)
+
+    def idle_content_ids(self, cutoff):
+        """
+        Yield the content IDs whose secret has not been read since the cutoff time
+        """
+        with self.lock:
+            idle = [content_id for content_id, accessed in self.accessed.items() if accessed < cutoff]
+        return iter(idle)
+
+    def last_accessed(self, content_id):
+        """
+        Return the last access time of the secret for a content ID, or None if there is none
+        """
+        return self.accessed.get(content_id)
+
+
+class RootKeySecretBackend:
+    """
+    This class is responsible for deriving content ID secrets from a single
+    root secret with HKDF-SHA256, so no per-content ID secret is stored.
+
+    Content IDs that already have a stored secret keep it when a legacy
+    backend is configured: the stored value is returned if it exists and
+    a secret is only derived for content IDs that have none. Without a
+    legacy manifest every content ID is looked up in the legacy backend;
+    with one, only the content IDs it lists are, so new content IDs need
+    no network call at all. Once every legacy content ID has been retired,
+    the legacy backend can be removed.
+
+    Every content ID has a secret in this mode, so key URLs served by the
+    derive key store carry a token that only this root secret can produce.
+    """
+
+    cache_locally = False
+
+    def __init__(self, root_secret, legacy_backend=None, legacy_content_ids=None):
+        if len(root_secret) < ROOT_KEY_MINIMUM_LENGTH:
+            raise Exception("Root secret must be at least {} characters".format(ROOT_KEY_MINIMUM_LENGTH))
+        self.root_secret = root_secret.encode('utf-8')
+        self.legacy_backend = legacy_backend
+        # None when every content ID may have a legacy secret
+        self.legacy_content_ids = legacy_content_ids
+        self.token_key = self.derive_bytes(b'speke key url token')
+
+    def derive_bytes(self, info):
+        """
+        Derive 32 bytes for a purpose from the root secret
+        """
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info, backend=default_backend())
+        return hkdf.derive(self.root_secret)
+
+    def derive(self, content_id):
+        """
+        Derive the secret for a content ID from the root secret
+        """
+        return self.derive_bytes(b'speke content id secret ' + content_id.encode('utf-8')).hex()
+
+    def url_token(self, content_id, key_id):
+        """
+        Return the token of the key URL for a content ID and key ID
+        """
+        message = "{}/{}".format(content_id, key_id).encode('utf-8')
+        return hmac.new(self.token_key, message, hashlib.sha256).hexdigest()[:32]
+
+    def get(self, content_id):
+        """
+        Return the stored legacy secret for a content ID, otherwise the derived secret
+        """
+        if self.is_legacy(content_id):
+            secret = self.legacy_backend.get(content_id)
+            if secret is not None:
+                print("LEGACY-SECRET {}".format(content_id))
+                return secret
+        return self.derive(content_id)
+
+    def is_legacy(self, content_id):
+        """
+        Check whether a content ID may have a stored legacy secret
+        """
+        if self.legacy_backend is None:
+            return False
+        return self.legacy_content_ids is None or content_id in self.legacy_content_ids
+
+    def create(self, content_id, secret):
+        """
+        Return the derived secret, nothing is stored in root key mode
+        """
+        return self.derive(content_id)
+
+    def delete(self, content_id):
+        """
+        Delete the stored legacy secret for a content ID, derived secrets cannot be deleted
+        """
+        if self.legacy_backend is None:
+            return False
+        return self.legacy_backend.delete(content_id)
+
+    def idle_content_ids(self, cutoff):
+        """
+        Yield the idle content IDs of the legacy backend, derived secrets are never idle
+        """
+        if self.legacy_backend is None:
+            return iter([])
+        return self.legacy_backend.idle_content_ids(cutoff)
+
+    def last_accessed(self, content_id):
+        """
+        Return the last access time of the stored legacy secret for a content ID, or None if there is none
+        """
+        if self.legacy_backend is None:
+            return None
+        return self.legacy_backend.last_accessed(content_id)
+
+
+def load_root_secret(secrets_client=None):
+    """
+    Load the root secret from the ROOT_KEY_FILE file or the ROOT_KEY_SECRET_ID secret
+    """
+    if ROOT_KEY_FILE:
+        with open(ROOT_KEY_FILE, 'r') as root_key_file:
+            return root_key_file.read().strip()
+    secrets_client = secrets_client if secrets_client is not None else get_client('secretsmanager')
+    return secrets_client.get_secret_value(SecretId=ROOT_KEY_SECRET_ID)['SecretString']
+
+
+def read_legacy_manifest(location, s3_client=None):
+    """
+    Return the set of content IDs in the legacy manifest at an s3://bucket/key location or file path
+    """
+    if location.startswith("s3://"):
+        bucket, _, key = location[len("s3://"):].partition("/")
+        s3_client = s3_client if s3_client is not None else get_client('s3')
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    else:
+        with open(location, 'rb') as manifest_file:
+            body = manifest_file.read()
+    return set(json.loads(body)["content_ids"])
+
+
+def write_legacy_manifest(location, content_ids, s3_client=None):
+    """
+    Write the legacy manifest to an s3://bucket/key location or file path
+    """
+    body = json.dumps({"content_ids": content_ids}).encode('utf-8')
+    if location.startswith("s3://"):
+        bucket, _, key = location[len("s3://"):].partition("/")
+        s3_client = s3_client if s3_client is not None else get_client('s3')
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body, ContentType='application/json')
+    else:
+        with open(location, 'wb') as manifest_file:
+            manifest_file.write(body)
+
+
+def create_secret_backend(name=None, secrets_client=None):
+    """
+    Create the secret backend selected by name or the SECRET_BACKEND setting
+    """
+    name = name or SECRET_BACKEND
+    if name == "rootkey":
+        legacy_backend = None
+        if ROOT_KEY_LEGACY_BACKEND == "rootkey":
+            raise Exception("The root key legacy backend must store secrets")
+        legacy_content_ids = None
+        if ROOT_KEY_LEGACY_BACKEND != "none":
+            legacy_backend = create_secret_backend(ROOT_KEY_LEGACY_BACKEND, secrets_client)
+            if ROOT_KEY_LEGACY_MANIFEST:
+                # a missing manifest fails the start, legacy content IDs must never get a derived secret
+                legacy_content_ids = read_legacy_manifest(ROOT_KEY_LEGACY_MANIFEST)
+                print("ROOT-KEY-LEGACY-CONTENT-IDS {}".format(len(legacy_content_ids)))
+        print("ROOT-KEY-LOAD")
+        return RootKeySecretBackend(load_root_secret(secrets_client), legacy_backend, legacy_content_ids)
+    if name == "secretsmanager":
+        return SecretsManagerBackend(secrets_client)
+    if name == "sqlite":
+        return SqliteSecretBackend(SECRET_SQLITE_PATH)
+    if name == "memory":
+        return MemorySecretBackend()
+    raise Exception("Invalid secret backend {}".format(name))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write the content IDs with a stored secret to the root key legacy manifest")
+    parser.add_argument("location", help="s3://bucket/key or file path, then set as ROOT_KEY_LEGACY_MANIFEST")
+    parser.add_argument("--backend", default=ROOT_KEY_LEGACY_BACKEND, help="backend holding the legacy secrets")
+    arguments = parser.parse_args()
+    content_ids = sorted(create_secret_backend(arguments.backend).content_ids())
+    write_legacy_manifest(arguments.location, content_ids)
+    print("LEGACY-MANIFEST {} content IDs".format(len(content_ids)))
@@ -0,0 +1,83 @@
+"""
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class SecretCache:
+    """
+    This class is responsible for keeping recently used content ID secrets
+    in process memory. Entries become stale after a time-to-live and the
+    least recently used entry is evicted when the cache is full.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+
+    def get(self, content_id):
+        """
+        Return the cached secret for a content ID if it has not expired, or None
+        """
+        secret, stale = self.lookup(content_id)
+        return None if stale else secret
+
+    def lookup(self, content_id):
+        """
+        Return the cached secret for a content ID and whether it has
+        expired, or (None, False). Content ID secrets never change, so an
+        expired entry is still valid and is kept until it is refreshed.
+        """
+        with self.lock:
+            entry = self.entries.get(content_id)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            secret, expires = entry
+            self.entries.move_to_end(content_id)
+            if expires < time.monotonic():
+                self.stale_hits += 1
+                return secret, True
+            self.hits += 1
+            return secret, False
+
+    def put(self, content_id, secret):
+        """
+        Add or replace the cached secret for a content ID
+        """
+        with self.lock:
+            self.entries[content_id] = (secret, time.monotonic() + self.ttl_seconds)
+            self.entries.move_to_end(content_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def remove(self, content_id):
+        """
+        Remove the cached secret for a content ID
+        """
+        with self.lock:
+            self.entries.pop(content_id, None)
+
+    def stats(self):
+        """
+        Return the cache counters
+        """
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "stale_hits": self.stale_hits}
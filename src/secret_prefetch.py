@@ -0,0 +1,184 @@
+"""
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_clients import get_client
+
+# manifest of recently active content IDs, s3://bucket/key or a file path, empty to disable.
+# It names content IDs, so keep it in a bucket that is not public, never in the key bucket,
+# whose objects are readable through CloudFront; the server role needs s3:GetObject and s3:PutObject on it
+SECRET_PREFETCH_MANIFEST = os.environ.get("SECRET_PREFETCH_MANIFEST", "")
+SECRET_PREFETCH_MAX_CONTENT_IDS = int(os.environ.get("SECRET_PREFETCH_MAX_CONTENT_IDS", "1000"))
+SECRET_PREFETCH_WORKERS = int(os.environ.get("SECRET_PREFETCH_WORKERS", "16"))
+SECRET_PREFETCH_FLUSH_SECONDS = int(os.environ.get("SECRET_PREFETCH_FLUSH_SECONDS", "60"))
+# container initialization waits at most this long for the prefetch, the rest carries on
+# in the background and content IDs not started by then are left to the first request
+SECRET_PREFETCH_DEADLINE_SECONDS = float(os.environ.get("SECRET_PREFETCH_DEADLINE_SECONDS", "3"))
+
+
+class SecretPrefetcher:
+    """
+    This class is responsible for loading the secrets of recently active
+    content IDs into the key generator's memory cache at cold start, and
+    for keeping the manifest of recently active content IDs up to date.
+    """
+
+    def __init__(self, generator, location, s3_client=None):
+        self.generator = generator
+        self.location = location
+        self.s3_client = s3_client
+        self.max_content_ids = SECRET_PREFETCH_MAX_CONTENT_IDS
+        self.workers = SECRET_PREFETCH_WORKERS
+        self.flush_seconds = SECRET_PREFETCH_FLUSH_SECONDS
+        self.deadline_seconds = SECRET_PREFETCH_DEADLINE_SECONDS
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        self.flushing = False
+        self.dirty = False
+        if self.location.startswith("s3://") and self.s3_client is None:
+            self.s3_client = get_client('s3')
+
+    def s3_location(self):
+        """
+        Return the bucket and key of an S3 manifest location
+        """
+        bucket, _, key = self.location[len("s3://"):].partition("/")
+        return bucket, key
+
+    def read_manifest(self):
+        """
+        Return the content IDs in the manifest, most recently active first
+        """
+        try:
+            if self.location.startswith("s3://"):
+                bucket, key = self.s3_location()
+                body = self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+            else:
+                with open(self.location, 'rb') as manifest_file:
+                    body = manifest_file.read()
+        except Exception as exception:
+            # a missing manifest only means there is nothing to prefetch
+            print("PREFETCH-MANIFEST-UNAVAILABLE {}".format(exception))
+            return []
+        return json.loads(body).get("content_ids", [])[:self.max_content_ids]
+
+    def write_manifest(self, content_ids):
+        """
+        Replace the manifest with the given content IDs
+        """
+        body = json.dumps({"content_ids": content_ids}).encode('utf-8')
+        if self.location.startswith("s3://"):
+            bucket, key = self.s3_location()
+            self.s3_client.put_object(Bucket=bucket, Key=key, Body=body, ContentType='application/json')
+        else:
+            temporary_path = "{}.{}.tmp".format(self.location, os.getpid())
+            with open(temporary_path, 'wb') as manifest_file:
+                manifest_file.write(body)
+            os.replace(temporary_path, self.location)
+
+    def prefetch(self):
+        """
+        Load the secrets of the content IDs in the manifest concurrently,
+        returning when they are loaded or the deadline has passed
+        """
+        deadline = time.monotonic() + self.deadline_seconds
+        thread = threading.Thread(target=self.prefetch_all, args=(deadline,), name="speke-prefetch", daemon=True)
+        thread.start()
+        thread.join(self.deadline_seconds)
+        if thread.is_alive():
+            print("PREFETCH-DEADLINE {:.1f} s".format(self.deadline_seconds))
+
+    def prefetch_all(self, deadline):
+        """
+        Load the secrets of the content IDs in the manifest, not starting any after the deadline
+        """
+        content_ids = self.read_manifest()
+        with self.lock:
+            # oldest first, so the most recent content ID ends up last
+            for content_id in reversed(content_ids):
+                self.recent[content_id] = True
+        if not content_ids:
+            return 0
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="speke-prefetch") as executor:
+            results = list(executor.map(lambda content_id: self.prefetch_one(content_id, deadline), content_ids))
+        loaded = sum(1 for result in results if result)
+        print("PREFETCH-SECRETS {} of {} in {:.0f} ms".format(loaded, len(content_ids), (time.monotonic() - started) * 1000))
+        return loaded
+
+    def prefetch_one(self, content_id, deadline):
+        """
+        Load one content ID secret, failures only cost a later cache miss
+        """
+        if time.monotonic() >= deadline:
+            return False
+        try:
+            return self.generator.prefetch_content_id_secret(content_id)
+        except Exception as exception:
+            print("PREFETCH-SECRET-FAILED {} {}".format(content_id, exception))
+            return False
+
+    def record(self, content_id):
+        """
+        Mark a content ID as recently active and write the manifest in
+        the background when it is due
+        """
+        with self.lock:
+            if content_id in self.recent:
+                self.recent.move_to_end(content_id)
+            else:
+                self.recent[content_id] = True
+                self.dirty = True
+                while len(self.recent) > self.max_content_ids:
+                    self.recent.popitem(last=False)
+            due = self.dirty and not self.flushing and time.monotonic() - self.last_flush >= self.flush_seconds
+            if due:
+                self.flushing = True
+        if due:
+            threading.Thread(target=self.flush, name="speke-manifest", daemon=True).start()
+
+    def merge_manifest(self, content_ids):
+        """
+        Return this container's content IDs, most recent first, followed by
+        the ones other containers wrote to the manifest, so containers do not
+        drop each other's content IDs
+        """
+        merged = OrderedDict((content_id, True) for content_id in content_ids)
+        for content_id in self.read_manifest():
+            if len(merged) >= self.max_content_ids:
+                break
+            merged.setdefault(content_id, True)
+        return list(merged)[:self.max_content_ids]
+
+    def flush(self):
+        """
+        Merge the recently active content IDs into the manifest
+        """
+        with self.lock:
+            content_ids = list(reversed(self.recent))
+            self.dirty = False
+        try:
+            self.write_manifest(self.merge_manifest(content_ids))
+        except Exception as exception:
+            print("PREFETCH-MANIFEST-WRITE-FAILED {}".format(exception))
+            with self.lock:
+                self.dirty = True
+        finally:
+            with self.lock:
+                self.flushing = False
+                self.last_flush = time.monotonic()
@@ -0,0 +1,151 @@
+"""
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing,
+software distributed under the License is distributed on an
+"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+KIND, either express or implied.  See the License for the
+specific language governing permissions and limitations
+under the License.
+"""
+
+import os
+import threading
+import xml.etree.ElementTree as element_tree
+
+from cpix_model import (CONTENT_KEY, CONTENT_KEY_LIST, DELIVERY_DATA, DELIVERY_DATA_LIST, DELIVERY_KEY, DRM_SYSTEM, DRM_SYSTEM_LIST, X509_CERTIFICATE, X509_DATA)
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+# XML parser, "elementtree", "lxml" or "auto" (lxml when it is installed)
+# lxml parses about twice as fast, but walking its tree to write the response
+# is slower, see misc/xml_benchmark.py before changing the default
+XML_BACKEND = os.environ.get("XML_BACKEND", "elementtree")
+# bytes of a streamed request handed to the parser at a time
+XML_STREAM_FEED_SIZE = int(os.environ.get("XML_STREAM_FEED_SIZE", "65536"))
+
+CPIX_XPATH_NAMESPACES = {"cpix": "urn:dashif:org:cpix", "ds": "http://www.w3.org/2000/09/xmldsig#"}
+
+
+class ElementTreeBackend:
+    """
+    This class is responsible for parsing CPIX requests with the standard
+    library ElementTree and finding the CPIX lists in a single pass over
+    the children of the root.
+    """
+
+    name = "elementtree"
+
+    def parse(self, body):
+        """
+        Parse a request body into its root element
+        """
+        return element_tree.fromstring(body)
+
+    def iterparse(self, body):
+        """
+        Parse a request body incrementally, yielding the start and end
+        events of its elements. The text of an element is known at the
+        next event after its start, and its tail at the next event after
+        its end, so a caller can write and release elements as they end.
+        """
+        parser = element_tree.XMLPullParser(events=("start", "end"))
+        for offset in range(0, len(body), XML_STREAM_FEED_SIZE):
+            parser.feed(body[offset:offset + XML_STREAM_FEED_SIZE])
+            yield from parser.read_events()
+        parser.close()
+        yield from parser.read_events()
+
+    def select_lists(self, root):
+        """
+        Return the DeliveryData, DRMSystem and ContentKey elements of a request
+        """
+        selected = {DELIVERY_DATA: [], DRM_SYSTEM: [], CONTENT_KEY: []}
+        item_tags = {DELIVERY_DATA_LIST: DELIVERY_DATA, DRM_SYSTEM_LIST: DRM_SYSTEM, CONTENT_KEY_LIST: CONTENT_KEY}
+        for element_list in root:
+            item_tag = item_tags.get(element_list.tag)
+            if item_tag is not None:
+                selected[item_tag].extend(element for element in element_list if element.tag == item_tag)
+        return selected[DELIVERY_DATA], selected[DRM_SYSTEM], selected[CONTENT_KEY]
+
+    def certificate(self, delivery_data):
+        """
+        Return the X509Certificate element of a DeliveryData, or None
+        """
+        delivery_key = delivery_data.find(DELIVERY_KEY)
+        if delivery_key is None:
+            return None
+        x509_data = delivery_key.find(X509_DATA)
+        if x509_data is None:
+            return None
+        return x509_data.find(X509_CERTIFICATE)
+
+
+class LxmlBackend:
+    """
+    This class is responsible for parsing CPIX requests with lxml and
+    finding the CPIX lists with precompiled XPath expressions. Comments
+    and processing instructions are dropped while parsing, as ElementTree
+    does, so the response written from either tree is the same.
+    """
+
+    name = "lxml"
+
+    def __init__(self):
+        self.local = threading.local()
+        self.delivery_data_path = lxml_etree.XPath("cpix:DeliveryDataList/cpix:DeliveryData", namespaces=CPIX_XPATH_NAMESPACES)
+        self.drm_systems_path = lxml_etree.XPath("cpix:DRMSystemList/cpix:DRMSystem", namespaces=CPIX_XPATH_NAMESPACES)
+        self.content_keys_path = lxml_etree.XPath("cpix:ContentKeyList/cpix:ContentKey", namespaces=CPIX_XPATH_NAMESPACES)
+        self.certificate_path = lxml_etree.XPath("cpix:DeliveryKey/ds:X509Data/ds:X509Certificate", namespaces=CPIX_XPATH_NAMESPACES)
+
+    def parser(self, encoding=None):
+        """
+        Return the parser for the calling thread, lxml parsers cannot be shared between threads
+        """
+        name = "parser_{}".format(encoding)
+        parser = getattr(self.local, name, None)
+        if parser is None:
+            parser = lxml_etree.XMLParser(encoding=encoding, remove_comments=True, remove_pis=True, resolve_entities=False, no_network=True)
+            setattr(self.local, name, parser)
+        return parser
+
+    def parse(self, body):
+        """
+        Parse a request body into its root element
+        """
+        if isinstance(body, str):
+            # lxml only parses text with an encoding declaration as bytes
+            return lxml_etree.fromstring(body.encode('utf-8'), self.parser('utf-8'))
+        return lxml_etree.fromstring(body, self.parser())
+
+    def select_lists(self, root):
+        """
+        Return the DeliveryData, DRMSystem and ContentKey elements of a request
+        """
+        return self.delivery_data_path(root), self.drm_systems_path(root), self.content_keys_path(root)
+
+    def certificate(self, delivery_data):
+        """
+        Return the X509Certificate element of a DeliveryData, or None
+        """
+        certificates = self.certificate_path(delivery_data)
+        return certificates[0] if certificates else None
+
+
+def create_xml_backend(name=None):
+    """
+    Create the XML backend selected by name or the XML_BACKEND setting
+    """
+    name = name or XML_BACKEND
+    if name == "auto":
+        name = "lxml" if lxml_etree is not None else "elementtree"
+    if name == "lxml":
+        if lxml_etree is None:
+            raise Exception("The lxml XML backend requires the lxml package")
+        return LxmlBackend()
+    if name == "elementtree":
+        return ElementTreeBackend()
+    raise Exception("Invalid XML backend {}".format(name))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+# Apache License
+# Version 2.0, January 2004
+# http://www.apache.org/licenses/
+
+import glob
+import os
+import sys
+import unittest
+import xml.etree.ElementTree as element_tree
+from unittest import mock
+
+# static DRM settings read when key_server_common is imported -- no changes needed
+DRM_SETTINGS = {
+    "FAIRPLAY_HLS_SIGNALING_DATA_MEDIA": "fairplay-media",
+    "FAIRPLAY_HLS_SIGNALING_DATA_MASTER": "fairplay-master",
+    "WIDEVINE_PSSH_BOX": "widevine-pssh",
+    "WIDEVINE_PROTECTION_HEADER": "widevine-protection-header",
+    "WIDEVINE_CONTENT_PROTECTION_DATA": "widevine-content-protection-data",
+    "WIDEVINE_HLS_SIGNALING_DATA_MEDIA": "widevine-media",
+    "WIDEVINE_HLS_SIGNALING_DATA_MASTER": "widevine-master",
+    "PLAYREADY_PSSH_BOX": "playready-pssh",
+    "PLAYREADY_PROTECTION_HEADER": "playready-protection-header",
+    "PLAYREADY_CONTENT_KEY": "playready-content-key",
+    "PLAYREADY_CONTENT_PROTECTION_DATA": "playready-content-protection-data",
+    "PLAYREADY_HLS_SIGNALING_DATA_MEDIA": "playready-media",
+    "PLAYREADY_HLS_SIGNALING_DATA_MASTER": "playready-master"
+}
+for name, value in DRM_SETTINGS.items():
+    os.environ.setdefault(name, value)
+
+TESTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_FOLDER, "..", "src"))
+
+import key_server_common
+from key_cache import KeyCache
+from key_generator import KeyGenerator
+from key_store import MemoryKeyStore
+from secret_backend import MemorySecretBackend
+from xml_backend import create_xml_backend
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+# request bodies rendered by every test
+FIXTURES = sorted(glob.glob(os.path.join(TESTS_FOLDER, "server_api_body*.xml")))
+
+
+def apply_changes(writer, root):
+    """
+    Make the changes recorded by a CpixWriter to the request tree itself,
+    the way the server built responses before the writer existed
+    """
+    parents = {child: parent for parent in root.iter() for child in parent}
+    for element, text in writer.texts.items():
+        element.text = text
+    for element, attributes in writer.attributes.items():
+        for name, value in attributes:
+            element.set(name, value)
+    for element, nodes in writer.appended.items():
+        for node in nodes:
+            append_node(element, node)
+    for element in writer.removed:
+        parents[element].remove(element)
+
+
+def append_node(parent, node):
+    """
+    Add a node written by a CpixWriter, and its children, to a tree
+    """
+    element = element_tree.SubElement(parent, node.tag, dict(node.attributes))
+    element.text = node.text
+    for child in node.children:
+        append_node(element, child)
+
+
+class TestCpixResponses(unittest.TestCase):
+    """
+    This class is responsible for testing that every way of writing a
+    response returns the same bytes as ElementTree.tostring() of the
+    request tree with the same changes made to it.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # one generator for every render, so each request gets the same keys
+        cls.generator = KeyGenerator(MemorySecretBackend())
+        cls.cache = KeyCache(MemoryKeyStore(), "https://keys.example.com")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.cache.close()
+        cls.generator.close()
+
+    def builder(self, path):
+        """
+        Return a response builder for a fixture, of the SPEKE version its name implies
+        """
+        with open(path, "rb") as fixture:
+            body = fixture.read()
+        if "spekev2" in os.path.basename(path):
+            return key_server_common.ServerResponseBuilderV2(body, self.cache, self.generator)
+        return key_server_common.ServerResponseBuilder(body, self.cache, self.generator)
+
+    def baseline(self, path):
+        """
+        Render a fixture through the general path and ElementTree.tostring()
+        """
+        with mock.patch.object(key_server_common, "XML_BACKEND", create_xml_backend("elementtree")):
+            builder = self.builder(path)
+        with mock.patch.object(builder, "is_hls_aes_128_rotation", return_value=False):
+            builder.fill_request()
+        apply_changes(builder.writer, builder.root)
+        return element_tree.tostring(builder.root).decode('utf-8')
+
+    def render(self, path, xml_backend="elementtree", streaming_threshold=key_server_common.CPIX_STREAMING_THRESHOLD):
+        """
+        Render a fixture the way the server does, with the given parser and streaming threshold
+        """
+        with mock.patch.object(key_server_common, "XML_BACKEND", create_xml_backend(xml_backend)), \
+                mock.patch.object(key_server_common, "CPIX_STREAMING_THRESHOLD", streaming_threshold):
+            response = self.builder(path).get_response()
+        self.assertEqual(200, response["statusCode"])
+        return response["body"]
+
+    def test_fixtures(self):
+        """
+        This function checks that the fixtures are found.
+        """
+        self.assertTrue(FIXTURES)
+
+    def test_writer(self):
+        """
+        This function tests the response writer with the ElementTree parser.
+        """
+        for path in FIXTURES:
+            with self.subTest(fixture=os.path.basename(path)):
+                self.assertEqual(self.baseline(path), self.render(path))
+
+    def test_lxml_writer(self):
+        """
+        This function tests the response writer with the lxml parser.
+        """
+        if lxml is None:
+            self.skipTest("lxml is not installed")
+        for path in FIXTURES:
+            with self.subTest(fixture=os.path.basename(path)):
+                self.assertEqual(self.baseline(path), self.render(path, xml_backend="lxml"))
+
+    def test_streaming(self):
+        """
+        This function tests streamed requests, one ContentKey per chunk and one chunk for all.
+        """
+        for chunk_size in (1, key_server_common.CPIX_STREAMING_CHUNK_SIZE):
+            for path in FIXTURES:
+                with self.subTest(fixture=os.path.basename(path), chunk_size=chunk_size):
+                    with mock.patch.object(key_server_common, "CPIX_STREAMING_CHUNK_SIZE", chunk_size):
+                        self.assertEqual(self.baseline(path), self.render(path, streaming_threshold=0))
+
+    def test_hls_aes_128_rotation(self):
+        """
+        This function tests that the HLS AES-128 rotation fast path is taken and writes the same response.
+        """
+        path = os.path.join(TESTS_FOLDER, "server_api_body.xml")
+        self.assertTrue(self.builder(path).is_hls_aes_128_rotation())
+        self.assertEqual(self.baseline(path), self.render(path))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+# Apache License
+# Version 2.0, January 2004
+# http://www.apache.org/licenses/
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from key_cache import KeyCache
+from key_generator import KeyGenerator
+from key_store import MemoryKeyStore
+from secret_backend import MemorySecretBackend
+from secret_cache import SecretCache
+
+# static test data -- no changes needed
+CONTENT_ID = "5E99137A-BD6C-4ECC-A24D-A3EE04B4E011"
+KEY_IDS = ["6c5f5206-7d98-4808-84d8-94f132c1e9fe", "0f083e4e-b831-4a3d-917e-ce78076e54aa", "041fdd3a-7f5e-4848-a7cb-65e97758e9a0"]
+SECRET = "a" * 64
+NEW_SECRET = "b" * 64
+
+
+class BatchingKeyStore(MemoryKeyStore):
+    """
+    This class is responsible for recording how a key cache writes to a
+    key store that accepts batches of keys.
+    """
+
+    batch_size = 2
+
+    def __init__(self):
+        MemoryKeyStore.__init__(self)
+        self.writes = []
+
+    def put(self, content_id, key_id, key_value):
+        self.writes.append([key_id])
+        MemoryKeyStore.put(self, content_id, key_id, key_value)
+
+    def put_many(self, content_id, keys):
+        self.writes.append([key_id for key_id, _ in keys])
+        for key_id, key_value in keys:
+            MemoryKeyStore.put(self, content_id, key_id, key_value)
+
+
+class UnstoredKeyStore(MemoryKeyStore):
+    """
+    This class is responsible for standing in for a key store that
+    derives keys again instead of storing them.
+    """
+
+    stores_keys = False
+
+    def put(self, content_id, key_id, key_value):
+        raise Exception("Unexpected put of {}/{}".format(content_id, key_id))
+
+
+class FailingKeyStore(MemoryKeyStore):
+    """
+    This class is responsible for standing in for a key store whose writes fail.
+    """
+
+    def put(self, content_id, key_id, key_value):
+        raise Exception("Put failed")
+
+
+class CountingSecretBackend(MemorySecretBackend):
+    """
+    This class is responsible for counting the secret reads of a key
+    generator, holding them until they are released.
+    """
+
+    def __init__(self):
+        MemorySecretBackend.__init__(self)
+        self.gets = 0
+        self.started = threading.Event()
+        self.released = threading.Event()
+        self.released.set()
+
+    def get(self, content_id):
+        self.gets += 1
+        self.started.set()
+        self.released.wait()
+        return MemorySecretBackend.get(self, content_id)
+
+
+def generate_keys():
+    """
+    Yield (key ID, key) pairs for the test key IDs
+    """
+    for index, key_id in enumerate(KEY_IDS):
+        yield key_id, bytes([index]) * 16
+
+
+class TestKeyCache(unittest.TestCase):
+    """
+    This class is responsible for testing the key writes of the key cache.
+    """
+
+    def key_cache(self, key_store):
+        cache = KeyCache(key_store, "https://keys.example.com")
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_store_many(self):
+        """
+        This function tests that every key is stored and returned.
+        """
+        key_store = MemoryKeyStore()
+        keys = self.key_cache(key_store).store_many(CONTENT_ID, generate_keys())
+        self.assertEqual(dict(generate_keys()), keys)
+        self.assertEqual({(CONTENT_ID, key_id): key_value for key_id, key_value in generate_keys()}, key_store.keys)
+
+    def test_store_many_batches(self):
+        """
+        This function tests that keys are written in full batches, with a last single key written alone.
+        """
+        key_store = BatchingKeyStore()
+        self.key_cache(key_store).store_many(CONTENT_ID, generate_keys())
+        self.assertEqual([KEY_IDS[:2], KEY_IDS[2:]], key_store.writes)
+
+    def test_store_many_known_keys(self):
+        """
+        This function tests that stored keys are not written again until the known keys expire.
+        """
+        key_store = BatchingKeyStore()
+        cache = self.key_cache(key_store)
+        cache.store_many(CONTENT_ID, generate_keys())
+        keys = cache.store_many(CONTENT_ID, generate_keys())
+        self.assertEqual(dict(generate_keys()), keys)
+        self.assertEqual(2, len(key_store.writes))
+        self.assertEqual(len(KEY_IDS), cache.stats()["skipped_writes"])
+        cache.known_keys_ttl = 0
+        cache.store_many(CONTENT_ID, generate_keys())
+        self.assertEqual(4, len(key_store.writes))
+
+    def test_store_many_unstored(self):
+        """
+        This function tests that keys are returned without any write when the key store does not store keys.
+        """
+        cache = self.key_cache(UnstoredKeyStore())
+        self.assertEqual(dict(generate_keys()), cache.store_many(CONTENT_ID, generate_keys()))
+        cache.store(CONTENT_ID, KEY_IDS[0], b"\x00" * 16)
+
+    def test_store_many_failure(self):
+        """
+        This function tests that a failed write fails the request and the key is not remembered.
+        """
+        cache = self.key_cache(FailingKeyStore())
+        with self.assertRaises(Exception):
+            cache.store_many(CONTENT_ID, generate_keys())
+        self.assertFalse(cache.is_known(CONTENT_ID, KEY_IDS[0]))
+
+
+class TestKeyGenerator(unittest.TestCase):
+    """
+    This class is responsible for testing how the key generator loads
+    and refreshes content ID secrets.
+    """
+
+    def setUp(self):
+        self.backend = CountingSecretBackend()
+        self.backend.create(CONTENT_ID, SECRET)
+        self.generator = KeyGenerator(self.backend)
+        self.addCleanup(self.generator.close)
+
+    def retrieve_concurrently(self, count):
+        """
+        Retrieve the test secret from several threads at once, returning what each one got
+        """
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.generator.retrieve_content_id_secret(CONTENT_ID))) for _ in range(count)]
+        self.backend.released.clear()
+        for thread in threads:
+            thread.start()
+        self.assertTrue(self.backend.started.wait(5))
+        # give every thread the time to wait for the same load
+        time.sleep(0.1)
+        self.backend.released.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def wait_for_refreshes(self):
+        """
+        Wait until the background secret refreshes have completed
+        """
+        deadline = time.monotonic() + 5
+        while self.generator.secret_refreshes and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(self.generator.secret_refreshes)
+
+    def test_single_flight(self):
+        """
+        This function tests that concurrent requests for an uncached secret share one backend read.
+        """
+        self.assertEqual([SECRET] * 8, self.retrieve_concurrently(8))
+        self.assertEqual(1, self.backend.gets)
+        self.assertEqual(SECRET, self.generator.retrieve_content_id_secret(CONTENT_ID))
+        self.assertEqual(1, self.backend.gets)
+        self.assertFalse(self.generator.secret_requests)
+
+    def test_single_flight_create(self):
+        """
+        This function tests that concurrent requests for a new content ID create one secret.
+        """
+        self.backend.delete(CONTENT_ID)
+        results = self.retrieve_concurrently(8)
+        self.assertEqual(1, len(set(results)))
+        self.assertEqual(8, len(results))
+        self.assertEqual(1, self.backend.gets)
+        self.assertEqual(results[0], self.backend.secrets[CONTENT_ID])
+
+    def test_stale_refresh(self):
+        """
+        This function tests that a stale secret is served while one background read refreshes it.
+        """
+        self.generator.secret_cache = SecretCache(10, -1)
+        self.generator.secret_cache.put(CONTENT_ID, SECRET)
+        self.backend.secrets[CONTENT_ID] = NEW_SECRET
+        self.backend.released.clear()
+        self.assertEqual(SECRET, self.generator.retrieve_content_id_secret(CONTENT_ID))
+        self.assertTrue(self.backend.started.wait(5))
+        self.assertEqual(SECRET, self.generator.retrieve_content_id_secret(CONTENT_ID))
+        self.backend.released.set()
+        self.wait_for_refreshes()
+        self.assertEqual(1, self.backend.gets)
+        self.assertEqual((NEW_SECRET, True), self.generator.secret_cache.lookup(CONTENT_ID))
+
+    def test_refresh_deleted(self):
+        """
+        This function tests that a refresh forgets a secret deleted from the backend.
+        """
+        self.generator.secret_cache.put(CONTENT_ID, SECRET)
+        self.backend.delete(CONTENT_ID)
+        self.generator.refresh_content_id_secret(CONTENT_ID)
+        self.assertEqual((None, False), self.generator.secret_cache.lookup(CONTENT_ID))
+
+    def test_refresh_failure(self):
+        """
+        This function tests that a failed refresh keeps serving the cached secret.
+        """
+        self.generator.secret_cache.put(CONTENT_ID, SECRET)
+        self.backend.get = self.fail_get
+        self.generator.refresh_content_id_secret(CONTENT_ID)
+        self.assertEqual(SECRET, self.generator.secret_cache.get(CONTENT_ID))
+        self.assertTrue(self.generator.cache_stats()["backend"]["degraded"])
+
+    def fail_get(self, content_id):
+        raise Exception("Secret backend unavailable for {}".format(content_id))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)